@@ -0,0 +1,61 @@
+import sys
+from collections import OrderedDict
+from hashlib import sha256
+
+PEM_PREFIX = '-----BEGIN'
+
+class AccountRegistry:
+    """
+    Maps public keys to account ids, i.e., the hex SHA-256 digests of the PEM
+    public keys. The state, the utxo records and the transactions refer to
+    accounts by id; the full public key is only needed to check the signature
+    of a sender. Ids are interned, so every id is stored once and shared by
+    all the records that refer to it.
+
+    Only the ids of the max_keys most recently used public keys are kept, so
+    that clients cannot grow the registry by sending arbitrary addresses.
+    """
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.ids = OrderedDict()
+        """
+        The variable ids maps public keys to their ids, least recently used first.
+        e.g.
+        {
+            '-----BEGIN PUBLIC KEY-----\\n...': '5f1c..'
+        }
+        """
+        self.keys = OrderedDict()   # id -> public key, for the most recent keys seen by the node
+
+    # The id of an address. Public keys are hashed; other addresses (ids, or
+    # the special sender '0' of the genesis transaction) are ids already and
+    # are not stored.
+    def account_id(self, address):
+        id = self.ids.get(address)
+        if id is not None:
+            try:
+                self.ids.move_to_end(address)
+            except KeyError:   # evicted by another thread meanwhile
+                pass
+            return id
+        if not isinstance(address, str):
+            return address
+        if not address.startswith(PEM_PREFIX):
+            return sys.intern(address)
+        id = sys.intern(sha256(address.encode("ISO-8859-1")).hexdigest())
+        self.ids[address] = id
+        self.keys[id] = address
+        if len(self.ids) > self.max_keys:
+            self.ids.popitem(last=False)
+        if len(self.keys) > self.max_keys:
+            self.keys.popitem(last=False)
+        return id
+
+    # The public key of an account id, if the node has seen it recently.
+    def public_key(self, id):
+        return self.keys.get(id)
+
+
+# Shared by the whole node.
+registry = AccountRegistry()
+account_id = registry.account_id
@@ -0,0 +1,57 @@
+import json
+import time
+import wire
+from threading import Condition, Thread
+
+class TransactionBatcher:
+    """
+    Coalesces the transactions that are relayed to the other nodes. A batch
+    is broadcast to the '/transactions' endpoint when it holds max_size
+    transactions or max_delay seconds after its first transaction arrived,
+    whichever comes first. The relayed transactions are stamped by the
+    tracer (if any).
+    """
+    def __init__(self, broadcaster, max_size=100, max_delay=0.005, tracer=None):
+        self.broadcaster = broadcaster
+        self.tracer = tracer
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.pending = []
+        self.condition = Condition()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, transaction):
+        with self.condition:
+            self.pending.append(transaction)
+            if len(self.pending) == 1 or len(self.pending) >= self.max_size:
+                self.condition.notify()
+
+    # This method runs on a separate thread.
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                deadline = time.monotonic() + self.max_delay
+                while len(self.pending) < self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = self.pending[:self.max_size]
+                del self.pending[:self.max_size]
+            self.send(batch)
+
+    def send(self, batch):
+        payload = json.dumps({ "transactions": [transaction.jsonfy() for transaction in batch] })
+        binary_payload = None
+        if self.broadcaster.wire_format == 'binary':
+            try:
+                binary_payload = wire.encode_transactions(batch)
+            except ValueError:
+                pass   # sent as JSON
+        self.broadcaster.broadcast_post(payload, '/transactions', wait=False,
+            binary_payload=binary_payload)
+        if self.tracer:
+            self.tracer.stamp_many([transaction.id for transaction in batch], 'relayed', len(batch))
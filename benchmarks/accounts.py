@@ -0,0 +1,48 @@
+"""
+Measure the memory held by the states of the blockchain and the size of the
+blocks when recipients are referred to by account id (as the nodes do) and by
+full public key.
+
+Run from the repository root:
+    python -m benchmarks.accounts
+"""
+import contextlib
+import io
+import json
+import tracemalloc
+from blockchain import Blockchain, block_dict
+from benchmarks.common import build_chain, make_wallets
+
+WALLETS = 50
+BLOCKS = 200
+CAPACITY = 10
+
+
+# Memory allocated (and kept) while the blocks are added to a new blockchain,
+# i.e., the memory of the states and the index. The blocks already exist.
+def states_memory(blocks):
+    blockchain = Blockchain(1, state_retention=BLOCKS + 1)
+    tracemalloc.start()
+    for block in blocks:
+        blockchain.add_block(block)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return memory
+
+
+def main():
+    wallets = make_wallets(WALLETS)
+    print('%d blocks x %d transactions, %d accounts' % (BLOCKS, CAPACITY, WALLETS))
+    print('%-12s %16s %18s' % ('recipients', 'states (KiB)', 'avg block (bytes)'))
+    for use_account_ids, name in [(False, 'public keys'), (True, 'account ids')]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            blockchain = Blockchain(1)
+            build_chain(blockchain, wallets, BLOCKS, CAPACITY, use_account_ids=use_account_ids)
+            blocks = blockchain.blocks_in_range(0, blockchain.length)
+            memory = states_memory(blocks)
+        block_size = sum(len(json.dumps(block_dict(block))) for block in blocks) / len(blocks)
+        print('%-12s %16.0f %18.0f' % (name, memory / 1024, block_size))
+
+
+if __name__ == '__main__':
+    main()
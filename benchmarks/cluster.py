@@ -0,0 +1,275 @@
+"""
+Run a cluster of nodes in one process, send them signed payments at a target
+rate and measure the sustained throughput, the confirmation latency, the
+stale blocks (mined but not in the main chain) and the CPU time of every
+node, for every combination of NUMBER_OF_NODES, DIFFICULTY and CAPACITY.
+
+The nodes talk through an in-memory transport instead of HTTP: a request is
+handled on a thread of the receiving node, as a server would. All the nodes
+share one interpreter (and the signature cache of the verifier), so the
+absolute numbers are lower than those of separate processes; the matrix is
+meant for comparing configurations. Every configuration runs in its own
+process.
+
+Run from the repository root:
+    python -m benchmarks.cluster
+"""
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from urllib.parse import parse_qs, urlsplit
+from requests.exceptions import ConnectionError, Timeout
+from blockchain import block_dict, parse_block
+from broadcaster import Broadcaster
+from transaction import Transaction
+from wallet import Wallet
+
+NODES = [2, 4]
+DIFFICULTIES = [2, 3]
+CAPACITIES = [5, 20]
+RATE = 50           # payments per second
+DURATION = 10       # seconds of payments
+DRAIN = 15          # seconds to wait for the last payments to be confirmed
+WALLETS = 16
+TOTAL_COINS = 1000000
+BOOTSTRAP_IP = '127.0.0.1'
+BOOTSTRAP_PORT = 5000
+
+
+class Response:
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class Server:
+    """
+    Handles the requests sent to a node, on threads of its own, like the
+    endpoints of a node do.
+    """
+    def __init__(self, name):
+        self.node = None
+        self.executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix=name)
+
+    def handle(self, method, endpoint, payload):
+        url = urlsplit(endpoint)
+        node = self.node
+        if method == 'GET' and url.path == '/blocks':
+            query = parse_qs(url.query)
+            start = int(query['start'][0])
+            end = int(query['end'][0])
+            blocks = node.blockchain.blocks_in_range(start, end)
+            return Response(200, json.dumps([block_dict(block) for block in blocks]))
+        data = json.loads(payload)
+        if url.path == '/registration':
+            node.store_node(BOOTSTRAP_IP, data['port'], data.get('wire_formats'))
+            return Response(200, json.dumps({'node_id': node.give_id()}))
+        if url.path == '/ring':
+            node.get_ring(data)
+            return Response(200, payload)
+        if url.path == '/block':
+            return Response(200, node.get_block(parse_block(data)))
+        if url.path == '/transaction':
+            transaction = Transaction(transaction_json=data['transaction_json'])
+            return Response(200, node.commit_transaction(transaction, data.get('is_local')))
+        if url.path == '/transactions':
+            transactions = [Transaction(transaction_json=transaction_json)
+                for transaction_json in data['transactions']]
+            return Response(200, json.dumps(node.commit_transactions(transactions)))
+        return Response(404, '')
+
+
+class MemoryBroadcaster(Broadcaster):
+    """
+    A broadcaster that delivers the requests to the servers of the nodes of
+    the same process.
+    """
+    def __init__(self, servers, timeout=5):
+        super().__init__(timeout=timeout)
+        self.servers = servers   # (ip, port) -> Server
+
+    def request(self, ip, port, method, endpoint, payload=None):
+        server = self.servers.get((ip, str(port)))
+        if not server:
+            raise ConnectionError('No node at ' + ip + ':' + str(port))
+        future = server.executor.submit(server.handle, method, endpoint, payload)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            raise Timeout('No response from ' + ip + ':' + str(port))
+
+    def send_post(self, ip, port, payload, endpoint='/', headers=None):
+        return self.request(ip, port, 'POST', endpoint, payload)
+
+    def send_get(self, ip, port, endpoint='/'):
+        return self.request(ip, port, 'GET', endpoint)
+
+
+# The CPU time (in seconds) of the threads, where available.
+def cpu_time(threads):
+    total = 0
+    for thread in threads:
+        try:
+            total += time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+        except (AttributeError, OSError, TypeError):
+            pass
+    return total
+
+
+def start_cluster(nodes, difficulty, capacity):
+    # Imported here so that the environment is read by the nodes only.
+    from node import Node
+    servers = {}
+    cluster = []
+    for i in range(nodes):
+        port = str(BOOTSTRAP_PORT + i)
+        os.environ.update({
+            'NUMBER_OF_NODES': str(nodes),
+            'DIFFICULTY': str(difficulty),
+            'CAPACITY': str(capacity),
+            'TOTAL_COINS': str(TOTAL_COINS),
+            'BOOTSTRAP_IP': BOOTSTRAP_IP,
+            'BOOTSTRAP_PORT': str(BOOTSTRAP_PORT),
+            'NODE_PORT': '' if i == 0 else port,
+        })
+        server = Server('node' + str(i))
+        servers[(BOOTSTRAP_IP, port)] = server
+        existing = set(threading.enumerate())
+        node = Node(broadcaster=MemoryBroadcaster(servers))
+        server.node = node
+        threading.Thread(target=node.process, name='node' + str(i) + '-process', daemon=True).start()
+        time.sleep(0.1)   # let the processing thread start the mining thread
+        node_threads = set(threading.enumerate()) - existing
+        cluster.append((node, server, node_threads))
+    cluster[0][0].distribute()
+    return cluster
+
+
+# Give every wallet an equal share of the coins and wait until every node
+# knows it.
+def fund(cluster, wallets, addresses):
+    bootstrap = cluster[0][0]
+    share = TOTAL_COINS // len(wallets)
+    for address in addresses[1:]:
+        transaction, error = bootstrap.create_candidate(addresses[0], address, share)
+        transaction.sign(wallets[0])
+        bootstrap.commit_transaction(transaction, True)
+    while not all(node.snapshot.state.get_balance(address) >= share
+        for node, _, _ in cluster for address in addresses[1:]):
+        time.sleep(0.1)
+
+
+def run(nodes, difficulty, capacity, seed=0):
+    rng = random.Random(seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        cluster = start_cluster(nodes, difficulty, capacity)
+        wallets = [Wallet() for _ in range(WALLETS)]
+        addresses = [wallet.serialize_public_key() for wallet in wallets]
+        cluster[0][0].make_genesis_block(addresses[0])
+        fund(cluster, wallets, addresses)
+        observer = cluster[0][0]
+        submitted = {}   # id -> time
+        confirmed = {}   # id -> time
+        done = []
+
+        # Wallet i pays through node i % nodes.
+        def pay():
+            start = time.perf_counter()
+            sent = 0
+            while time.perf_counter() - start < DURATION:
+                delay = start + sent / RATE - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                sent += 1
+                sender = rng.randrange(WALLETS)
+                recipient = rng.randrange(WALLETS - 1)
+                recipient += recipient >= sender
+                node = cluster[sender % nodes][0]
+                transaction, error = node.create_candidate(
+                    addresses[sender], addresses[recipient], rng.randint(1, 10))
+                if error:
+                    continue
+                transaction.sign(wallets[sender])
+                submitted[transaction.id] = time.perf_counter()
+                node.commit_transaction(transaction, True)
+
+        # The payments are confirmed when they are in the main chain of node 0.
+        def observe():
+            height = 1
+            while not done:
+                now = time.perf_counter()
+                length = observer.snapshot.length
+                for block in observer.blockchain.blocks_in_range(max(1, height - 2), length):
+                    for transaction in block['transactions']:
+                        if transaction.id in submitted and transaction.id not in confirmed:
+                            confirmed[transaction.id] = now
+                height = length
+                time.sleep(0.02)
+
+        threading.Thread(target=observe, daemon=True).start()
+        start = time.perf_counter()
+        pay()
+        deadline = time.perf_counter() + DRAIN
+        while len(confirmed) < len(submitted) and time.perf_counter() < deadline:
+            time.sleep(0.1)
+        elapsed = time.perf_counter() - start
+        done.append(True)
+
+    main_chain = set(block['current_hash']
+        for block in observer.blockchain.blocks_in_range(0, observer.blockchain.length))
+    all_blocks = set()
+    for node, _, _ in cluster:
+        all_blocks.update(node.blockchain.chain)
+    cpu = []
+    for node, server, node_threads in cluster:
+        threads = set(node_threads) | set(server.executor._threads)
+        cpu.append(cpu_time(threads) / elapsed * 100)
+    latencies = sorted(confirmed[id] - submitted[id] for id in confirmed)
+    last = max(confirmed.values()) if confirmed else start
+    return {
+        'submitted': len(submitted),
+        'confirmed': len(confirmed),
+        'tps': len(confirmed) / (last - start) if confirmed else 0,
+        'latencies': latencies,
+        'stale': len(all_blocks - main_chain),
+        'cpu': cpu,
+    }
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    print('%d payments/s for %d s, confirmation in the main chain of node 0' % (RATE, DURATION))
+    print('%5s %5s %5s %9s %9s %7s %7s %7s %7s %6s %12s' % ('nodes', 'diff', 'cap',
+        'submitted', 'confirmed', 'tps', 'p50 s', 'p90 s', 'p99 s', 'stale', 'cpu%/node'))
+    context = multiprocessing.get_context('spawn')
+    for nodes in NODES:
+        for difficulty in DIFFICULTIES:
+            for capacity in CAPACITIES:
+                with context.Pool(1, maxtasksperchild=1) as pool:
+                    result = pool.apply(run, (nodes, difficulty, capacity))
+                latencies = result['latencies']
+                print('%5d %5d %5d %9d %9d %7.1f %7.2f %7.2f %7.2f %6d %12s' % (
+                    nodes, difficulty, capacity,
+                    result['submitted'], result['confirmed'], result['tps'],
+                    percentile(latencies, 0.5), percentile(latencies, 0.9),
+                    percentile(latencies, 0.99), result['stale'],
+                    '/'.join('%.0f' % cpu for cpu in result['cpu'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Simulate transfers between accounts with each coin selection strategy and
+measure the inputs per transaction and the size of the utxo set. Only the
+utxos are simulated (no signatures), so that many transfers can be made.
+
+Run from the repository root:
+    python -m benchmarks.coin_selection
+"""
+import random
+import time
+import coin_selection
+
+ACCOUNTS = 100
+INITIAL_COINS = 1000
+TRANSFERS = 100000
+IDLE = 0.1   # fraction of the transfers made while the node is idle
+
+
+# The utxos in the order they were received, as the nodes used to spend them.
+def insertion_order(utxos, amount):
+    return coin_selection.largest_first(list(utxos.values()), amount)
+
+
+def sorted_strategy(select):
+    def select_sorted(utxos, amount):
+        return select(sorted(utxos.values(), key=lambda tx: tx['amount'], reverse=True), amount)
+    return select_sorted
+
+
+POLICIES = [
+    ('insertion order', insertion_order, insertion_order),
+    ('largest first', sorted_strategy(coin_selection.largest_first), None),
+    ('branch and bound', sorted_strategy(coin_selection.branch_and_bound), None),
+    ('b&b + consolidate', sorted_strategy(coin_selection.branch_and_bound),
+        sorted_strategy(coin_selection.consolidate)),
+]
+
+
+def simulate(select, select_idle, seed=0):
+    rng = random.Random(seed)
+    utxos = [{str(i): {'id': str(i), 'amount': INITIAL_COINS}} for i in range(ACCOUNTS)]
+    balances = [INITIAL_COINS] * ACCOUNTS
+    next_id = ACCOUNTS
+    inputs = 0
+    utxo_count = ACCOUNTS
+    utxo_total = 0
+    for _ in range(TRANSFERS):
+        sender = rng.randrange(ACCOUNTS)
+        recipient = rng.randrange(ACCOUNTS - 1)
+        recipient += recipient >= sender
+        amount = rng.choice([1, 2, 5, 10, 20, 50]) * rng.randint(1, 4)
+        if balances[sender] < amount:
+            amount = balances[sender]
+        if amount == 0:
+            continue
+        idle = select_idle and rng.random() < IDLE
+        spent = (select_idle if idle else select)(utxos[sender], amount)
+        change = sum(tx['amount'] for tx in spent) - amount
+        for tx in spent:
+            del utxos[sender][tx['id']]
+        utxos[recipient][str(next_id)] = {'id': str(next_id), 'amount': amount}
+        if change:
+            utxos[sender][str(next_id + 1)] = {'id': str(next_id + 1), 'amount': change}
+        next_id += 2
+        balances[sender] -= amount
+        balances[recipient] += amount
+        inputs += len(spent)
+        utxo_count += 1 + (change > 0) - len(spent)
+        utxo_total += utxo_count
+    return inputs / TRANSFERS, utxo_total / TRANSFERS, utxo_count
+
+
+def main():
+    print('%d transfers between %d accounts (%d%% while idle)' %
+        (TRANSFERS, ACCOUNTS, IDLE * 100))
+    print('%-18s %12s %12s %12s %10s' %
+        ('strategy', 'inputs/tx', 'avg utxos', 'final utxos', 'time (s)'))
+    for name, select, select_idle in POLICIES:
+        start = time.perf_counter()
+        inputs, average_utxos, final_utxos = simulate(select, select_idle)
+        print('%-18s %12.2f %12.0f %12d %10.2f' %
+            (name, inputs, average_utxos, final_utxos, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Helpers shared by the benchmarks.
+"""
+import random
+from accounts import account_id
+from state import State
+from transaction import Transaction
+from wallet import Wallet
+
+
+def make_wallets(count):
+    return [Wallet() for _ in range(count)]
+
+
+# A signed transaction of amount coins from sender (a wallet) to the recipient
+# (public key or account id), spending the sender's utxos in state. Like the
+# nodes do, the recipient is referred to by account id unless use_account_id
+# is False.
+def make_transaction(state, sender, recipient_address, amount, use_account_id=True):
+    sender_address = sender.serialize_public_key()
+    spent_txs = []
+    total = 0
+    for tx in state.account_utxos(sender_address).values():
+        total += tx['amount']
+        spent_txs.append(tx)
+        if total >= amount:
+            break
+    transaction = Transaction(
+        sender_address=sender_address,
+        recipient_address=account_id(recipient_address) if use_account_id else recipient_address,
+        amount=amount,
+        spent_txs=spent_txs)
+    transaction.sign(wallet=sender)
+    return transaction
+
+
+# Add a genesis block that gives total_coins to the first wallet and then
+# blocks of capacity random transfers between the wallets.
+def build_chain(
+    blockchain,
+    wallets,
+    blocks,
+    capacity,
+    total_coins=1000000,
+    seed=0,
+    use_account_ids=True):
+    rng = random.Random(seed)
+    addresses = [wallet.serialize_public_key() for wallet in wallets]
+    genesis_transaction = Transaction(
+        sender_address='0',
+        recipient_address=addresses[0],
+        amount=total_coins,
+        spent_txs=[{'id': 'genesis', 'recipient': '0', 'amount': total_coins}])
+    blockchain.add_block(blockchain.create_block([genesis_transaction]))
+    for _ in range(blocks):
+        state = State(initial_state=blockchain.tail_state())
+        transactions = []
+        while len(transactions) < capacity:
+            sender = rng.randrange(len(wallets))
+            recipient = rng.randrange(len(wallets))
+            balance = state.get_balance(addresses[sender])
+            if sender == recipient or balance < 2:
+                continue
+            amount = rng.randint(1, balance // 2)
+            transaction = make_transaction(
+                state, wallets[sender], addresses[recipient], amount, use_account_ids)
+            state.update(transaction)
+            transactions.append(transaction)
+        block = blockchain.create_block(transactions)
+        blockchain.mine_block(block)
+        blockchain.add_block(block)
+    return addresses
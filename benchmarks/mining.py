@@ -0,0 +1,81 @@
+"""
+Compare the hash rate of the original mining loop, which re-serializes the
+whole block for every nonce, with the prefix/midstate search of the miner over
+the whole block and over the block header (which commits to the transactions
+by their Merkle root).
+
+Run from the repository root:
+    python -m benchmarks.mining
+"""
+import json
+import time
+from hashlib import sha256
+from blockchain import Blockchain, block_dict, block_header
+from miner import search
+from transaction import Transaction
+from wallet import Wallet
+
+CAPACITIES = [3, 50, 500]
+DURATION = 2    # seconds per measurement
+IMPOSSIBLE = 64 # no hash begins with 64 zeros, so every nonce is tried
+
+
+def make_transactions(wallet, capacity):
+    sender = wallet.serialize_public_key()
+    transactions = []
+    for i in range(capacity):
+        transaction = Transaction(
+            sender_address=sender,
+            recipient_address=sender,
+            amount=1,
+            spent_txs=[{'id': sha256(str(i).encode()).hexdigest(), 'recipient': sender, 'amount': 2}])
+        transaction.sign(wallet)
+        transactions.append(transaction)
+    return transactions
+
+
+# The mining loop as it was before the midstate search.
+def json_search(block_data, difficulty, start, stop):
+    block_data = block_data.copy()
+    for nonce in range(start, stop):
+        block_data['nonce'] = nonce
+        block_dump = str.encode(json.dumps(block_data, sort_keys=True))
+        hash = sha256(block_dump).hexdigest()
+        if hash[:difficulty] == ('0' * difficulty):
+            return nonce, hash
+    return None
+
+
+# Hashes per second of kernel over DURATION seconds.
+def hash_rate(kernel, block_data):
+    batch = 1000
+    tried = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < DURATION:
+        kernel(block_data, IMPOSSIBLE, tried, tried + batch)
+        tried += batch
+    return tried / (time.perf_counter() - start)
+
+
+def main():
+    wallet = Wallet()
+    blockchain = Blockchain(difficulty=3)
+    print('%8s %14s %14s %14s %8s' %
+        ('capacity', 'json (H/s)', 'midstate (H/s)', 'header (H/s)', 'speedup'))
+    for capacity in CAPACITIES:
+        block = blockchain.create_block(make_transactions(wallet, capacity))
+        # Blocks found by the midstate search must still pass the proof check.
+        blockchain.mine_block(block)
+        assert blockchain.validate_block_proof(block)
+
+        block_data = block_dict(block)
+        del block_data['current_hash']
+        before = hash_rate(json_search, block_data)
+        midstate = hash_rate(search, block_data)
+        after = hash_rate(search, block_header(block))
+        print('%8d %14.0f %14.0f %14.0f %7.1fx' %
+            (capacity, before, midstate, after, after / before))
+
+
+if __name__ == '__main__':
+    main()
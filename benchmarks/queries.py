@@ -0,0 +1,109 @@
+"""
+Measure the latency of balance and utxo queries while blocks keep being added,
+when the queries take the state lock (as the nodes used to) and when they read
+the published snapshot.
+
+Run from the repository root:
+    python -m benchmarks.queries
+"""
+import contextlib
+import io
+import random
+import time
+from threading import Lock, Thread
+from blockchain import Blockchain
+from snapshot import Snapshot
+from verifier import verifier
+from benchmarks.common import build_chain, make_wallets
+
+WALLETS = 20
+BLOCKS = 200
+CAPACITY = 10
+READERS = 4
+
+
+class Chain:
+    """
+    The part of a node that adds blocks and publishes the tail state.
+    """
+    def __init__(self):
+        self.blockchain = Blockchain(1)
+        self.lock = Lock()
+        self.current_state = self.blockchain.tail_state()
+        self.snapshot = Snapshot()
+
+    def add_block(self, block):
+        with self.lock:
+            self.blockchain.add_block(block)
+            self.current_state = self.blockchain.tail_state()
+            self.snapshot = Snapshot(block, self.blockchain.length, self.current_state)
+
+
+def locked_query(chain, address):
+    with chain.lock:
+        chain.current_state.get_balance(address)
+        chain.current_state.account_utxos(address)
+
+
+def snapshot_query(chain, address):
+    state = chain.snapshot.state
+    state.get_balance(address)
+    state.account_utxos(address)
+
+
+# Add the blocks on one thread while READERS threads send queries. Returns the
+# query latencies (in seconds) and the time to add the blocks.
+def run(blocks, addresses, query):
+    verifier.clear()   # the signatures are verified again, as for foreign blocks
+    chain = Chain()
+    chain.add_block(blocks[0])
+    done = []
+    latencies = []
+
+    def read(seed):
+        rng = random.Random(seed)
+        while not done:
+            address = rng.choice(addresses)
+            start = time.perf_counter()
+            query(chain, address)
+            latencies.append(time.perf_counter() - start)
+            time.sleep(0)   # like a request handler, give way to the other threads
+
+    readers = [Thread(target=read, args=(seed,)) for seed in range(READERS)]
+    for reader in readers:
+        reader.start()
+    start = time.perf_counter()
+    for block in blocks[1:]:
+        chain.add_block(block)
+    elapsed = time.perf_counter() - start
+    done.append(True)
+    for reader in readers:
+        reader.join()
+    return sorted(latencies), elapsed
+
+
+def main():
+    with contextlib.redirect_stdout(io.StringIO()):
+        wallets = make_wallets(WALLETS)
+        blockchain = Blockchain(1)
+        addresses = build_chain(blockchain, wallets, BLOCKS, CAPACITY)
+        blocks = [blockchain.block_at(height) for height in range(blockchain.length)]
+
+    print('%d blocks x %d transactions added while %d threads query balances' %
+        (BLOCKS, CAPACITY, READERS))
+    print('%-10s %10s %10s %10s %10s %12s' %
+        ('queries', 'count', 'p50 (us)', 'p99 (us)', 'max (ms)', 'blocks (s)'))
+    for name, query in [('locked', locked_query), ('snapshot', snapshot_query)]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            latencies, elapsed = run(blocks, addresses, query)
+        print('%-10s %10d %10.1f %10.1f %10.2f %12.3f' % (
+            name,
+            len(latencies),
+            latencies[len(latencies) // 2] * 1e6,
+            latencies[len(latencies) * 99 // 100] * 1e6,
+            latencies[-1] * 1e3,
+            elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Measure how long a node needs to serve a balance query after a restart:
+loading the block log and the latest state snapshot vs. replaying (and
+re-verifying) every block from genesis.
+
+Run from the repository root:
+    python -m benchmarks.restart
+"""
+import contextlib
+import io
+import tempfile
+import time
+from blockchain import Blockchain
+from storage import BlockStore
+from verifier import verifier
+from benchmarks.common import build_chain, make_wallets
+
+BLOCKS = 300
+CAPACITY = 10
+CHECKPOINT_INTERVAL = 50
+
+
+def main():
+    with tempfile.TemporaryDirectory() as data_dir, contextlib.redirect_stdout(io.StringIO()):
+        wallets = make_wallets(10)
+        blockchain = Blockchain(1, checkpoint_interval=CHECKPOINT_INTERVAL, store=BlockStore(data_dir))
+        addresses = build_chain(blockchain, wallets, BLOCKS, CAPACITY)
+        blockchain.store.close()
+        blocks = [blockchain.block_at(height) for height in range(blockchain.length)]
+        expected = blockchain.tail_state().get_balance(addresses[0])
+
+        # Restart from the block log and the snapshot.
+        verifier.clear()
+        start = time.perf_counter()
+        restarted = Blockchain(1, checkpoint_interval=CHECKPOINT_INTERVAL, store=BlockStore(data_dir))
+        restarted.load()
+        balance = restarted.tail_state().get_balance(addresses[0])
+        load_time = time.perf_counter() - start
+        assert balance == expected
+
+        # Rebuild the state by replaying (and verifying) every block.
+        verifier.clear()
+        start = time.perf_counter()
+        replayed = Blockchain(1, checkpoint_interval=CHECKPOINT_INTERVAL)
+        for block in blocks:
+            replayed.add_block(block)
+        balance = replayed.tail_state().get_balance(addresses[0])
+        replay_time = time.perf_counter() - start
+        assert balance == expected
+
+    print('%d blocks x %d transactions' % (BLOCKS, CAPACITY))
+    print('restart from log + snapshot: %8.3f s' % load_time)
+    print('replay from genesis:         %8.3f s' % replay_time)
+
+
+if __name__ == '__main__':
+    main()
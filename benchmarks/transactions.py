@@ -0,0 +1,79 @@
+"""
+Measure the time to validate and add a foreign block (its transactions are
+consumed twice) when the transactions are parsed from their JSON strings on
+every use, as the nodes used to do, and when they are parsed once on arrival,
+and the memory held per stored transaction in both forms.
+
+Run from the repository root:
+    python -m benchmarks.transactions
+"""
+import contextlib
+import io
+import json
+import time
+import tracemalloc
+from blockchain import Blockchain, block_dict, parse_block
+from transaction import Transaction
+from benchmarks.common import build_chain, make_wallets
+
+WALLETS = 20
+BLOCKS = 50
+CAPACITIES = [10, 100]
+REPEAT = 5
+
+
+# Consume a block the way validate_block and add_block do, twice, with its
+# transactions as JSON strings parsed on every use.
+def consume_strings(state, block):
+    for _ in range(2):
+        parsed = dict(block, transactions=[Transaction(transaction_json=transaction_json)
+            for transaction_json in block['transactions']])
+        state.consume_block(parsed)
+
+
+# The same with the transactions parsed once, on arrival.
+def consume_objects(state, block):
+    parsed = parse_block(dict(block))
+    for _ in range(2):
+        state.consume_block(parsed)
+
+
+def consume_time(consume, states, blocks):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        for state, block in zip(states, blocks):
+            consume(state, block)
+    return (time.perf_counter() - start) / REPEAT / len(blocks) * 1000
+
+
+# Bytes allocated per transaction to keep the transactions of the blocks.
+def memory(blocks, load):
+    transactions = sum(len(block['transactions']) for block in blocks)
+    tracemalloc.start()
+    kept = [load(json.dumps(block)) for block in blocks]
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return allocated / transactions
+
+
+def main():
+    wallets = make_wallets(WALLETS)
+    print('%8s %16s %16s %16s %16s' % ('capacity', 'strings (ms)', 'objects (ms)',
+        'strings (B/tx)', 'objects (B/tx)'))
+    for capacity in CAPACITIES:
+        with contextlib.redirect_stdout(io.StringIO()):
+            blockchain = Blockchain(1)
+            build_chain(blockchain, wallets, BLOCKS, capacity)
+        blocks = [block_dict(blockchain.block_at(height)) for height in range(1, blockchain.length)]
+        states = [blockchain.get_state(block['previous_hash']) for block in blocks]
+        strings = consume_time(consume_strings, states, blocks)
+        objects = consume_time(consume_objects, states, blocks)
+        strings_memory = memory(blocks, json.loads)
+        objects_memory = memory(blocks, lambda data: parse_block(json.loads(data)))
+        print('%8d %16.2f %16.2f %16.0f %16.0f' %
+            (capacity, strings, objects, strings_memory, objects_memory))
+
+
+if __name__ == '__main__':
+    main()
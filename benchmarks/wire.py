@@ -0,0 +1,46 @@
+"""
+Compare the size of blocks on the wire and their encode/decode time in the
+JSON format and in the compact binary format.
+
+Run from the repository root:
+    python -m benchmarks.wire
+"""
+import json
+import time
+import wire
+from blockchain import Blockchain, block_dict, parse_block
+from benchmarks.mining import make_transactions
+from wallet import Wallet
+
+CAPACITIES = [3, 50, 500]
+REPEAT = 20
+
+
+def timed(function, argument):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        result = function(argument)
+    return result, (time.perf_counter() - start) / REPEAT * 1000
+
+
+def main():
+    wallet = Wallet()
+    blockchain = Blockchain(difficulty=1)
+    print('%8s %12s %12s %12s %12s %12s %12s' % ('capacity', 'json bytes', 'binary bytes',
+        'json enc ms', 'bin enc ms', 'json dec ms', 'bin dec ms'))
+    for capacity in CAPACITIES:
+        block = blockchain.create_block(make_transactions(wallet, capacity))
+        blockchain.mine_block(block)
+
+        json_payload, json_encode = timed(lambda block: json.dumps(block_dict(block)), block)
+        binary_payload, binary_encode = timed(wire.encode_block, block)
+        decoded, json_decode = timed(lambda payload: parse_block(json.loads(payload)), json_payload)
+        assert block_dict(decoded) == block_dict(block)
+        decoded, binary_decode = timed(wire.decode_block, binary_payload)
+        assert block_dict(decoded) == block_dict(block)
+        print('%8d %12d %12d %12.2f %12.2f %12.2f %12.2f' % (capacity, len(json_payload),
+            len(binary_payload), json_encode, binary_encode, json_decode, binary_decode))
+
+
+if __name__ == '__main__':
+    main()
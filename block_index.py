@@ -0,0 +1,72 @@
+from threading import Lock
+
+class BlockIndex:
+    """
+    Indexes the blocks of the blockchain so that they can be found without
+    following previous_hash pointers. It is updated incrementally whenever a
+    block is added.
+
+    The heights are read by the queries without the lock of the node, so they
+    are rewritten and read under their own lock.
+    """
+    def __init__(self):
+        self.heights = []
+        """
+        The variable heights is a list with the hashes of the blocks in the
+        main chain, i.e., heights[i] is the hash of the block with index i in
+        the chain that ends at the tail.
+        """
+
+        self.children = {}
+        """
+        The variable children is a dict with keys the block hashes and values
+        the lists of hashes of their children. A block with more than one child
+        is where the chain forks.
+        e.g.
+        { '00ab..': ['00cd..', '00ef..'] }
+        """
+
+        self.work = {}
+        """
+        The variable work stores for each block hash the cumulative work of the
+        chain that ends at that block, i.e., the expected number of hashes that
+        were needed to mine all of its blocks.
+        """
+
+        self.tips = set()   # blocks without children
+        self.lock_heights = Lock()
+
+    def add(self, block, block_work):
+        hash = block['current_hash']
+        parent = block['previous_hash']
+        self.children.setdefault(parent, []).append(hash)
+        self.work[hash] = self.work.get(parent, 0) + block_work
+        self.tips.discard(parent)
+        self.tips.add(hash)
+
+    # Make the chain that ends at the given block the main chain. Only the
+    # heights where the new main chain differs from the old one are rewritten.
+    def set_tip(self, hash, chain):
+        height = chain[hash]['index']
+        with self.lock_heights:
+            del self.heights[height + 1:]
+            if len(self.heights) < height + 1:
+                self.heights.extend([None] * (height + 1 - len(self.heights)))
+            while height >= 0 and self.heights[height] != hash:
+                self.heights[height] = hash
+                hash = chain[hash]['previous_hash']
+                height -= 1
+
+    def hash_at(self, height):
+        with self.lock_heights:
+            if 0 <= height < len(self.heights):
+                return self.heights[height]
+        return None
+
+    # The hashes of the main chain blocks with start <= index < end (a copy).
+    def hashes_in_range(self, start, end):
+        with self.lock_heights:
+            return self.heights[max(start, 0):max(end, 0)]
+
+    def heaviest_tip(self):
+        return max(self.tips, key=lambda hash: self.work[hash], default=None)
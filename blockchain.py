@@ -1,56 +1,144 @@
 from datetime import datetime
 import json
+import time
 from hashlib import sha256
 from transaction import Transaction
 from state import State
+from miner import Miner, search
+from block_index import BlockIndex
+import merkle
+from metrics import registry
+
+validation_time = registry.histogram(
+    'noobcash_block_validation_seconds', 'Time to validate a block (proof, previous hash and transactions)')
+
+# The fields of a block that are hashed for the proof-of-work. The transactions
+# are committed to by their Merkle root, so the cost of hashing a nonce does
+# not depend on the size of the block.
+HEADER_FIELDS = ['index', 'timestamp', 'merkle_root', 'nonce', 'previous_hash']
+
+
+def block_header(block):
+    return {field: block[field] for field in HEADER_FIELDS}
+
+
+def block_hash(block):
+    header_dump = str.encode(json.dumps(block_header(block), sort_keys=True))
+    return sha256(header_dump).hexdigest()
+
+
+# Blocks hold their transactions as Transaction objects. They are sent and
+# stored as JSON, with every transaction as its JSON string.
+def block_dict(block):
+    return dict(block, transactions=[transaction.jsonfy() for transaction in block['transactions']])
+
+
+# Parse the transactions of a block received (or loaded) as JSON, once.
+def parse_block(block):
+    block['transactions'] = [Transaction(transaction_json=transaction_json)
+        for transaction_json in block['transactions']]
+    return block
+
+
+def transactions_json(block):
+    return [transaction.jsonfy() for transaction in block['transactions']]
+
 
 class Blockchain:
-    def __init__(self, difficulty):
+    def __init__(
+        self,
+        difficulty,
+        mining_workers=1,
+        state_retention=100,
+        checkpoint_interval=100,
+        store=None):
         self.chain = {}
+        self.index = BlockIndex()
         self.states = {}
+        # Only the states of the last state_retention blocks and of every
+        # checkpoint_interval-th block are kept. Older states are rebuilt on
+        # demand by replaying blocks from the nearest kept state.
+        self.state_retention = state_retention
+        self.checkpoint_interval = checkpoint_interval
+        # Blocks are appended to the store (if any) and the state of every main
+        # chain checkpoint is saved as its snapshot.
+        self.store = store
         self.length = 0
         self.tail_hash = '1'
         self.difficulty = difficulty
+        self.block_work = 16 ** difficulty   # expected number of hashes per block
         self.mining_flag = False   # for stopping the mining process from another thread
+        # With more than one worker the nonce space is searched by a process pool.
+        self.miner = Miner(mining_workers) if mining_workers > 1 else None
+        # Mining statistics (see the /metrics endpoint).
+        self.blocks_mined = 0
+        self.blocks_interrupted = 0
+        self.mining_seconds = 0
+        self.nonces_tried = 0   # by this process; the workers of the miner count their own
+        self.hash_rate = 0      # of the last mining, in hashes per second
 
     # New blocks are returned (dictionaries) that should be mined before appended.  
     def create_block(self, transaction_list):
         block = {
             'index': self.length,
             'timestamp': str(datetime.now()),
-            'transactions': [transaction.jsonfy() for transaction in transaction_list],
+            'transactions': list(transaction_list),
+            'merkle_root': merkle.root([transaction.jsonfy() for transaction in transaction_list]),
             'nonce': 0,
             'previous_hash': self.tail_hash
         }
-        block_dump = str.encode(json.dumps(block, sort_keys=True))
-        block['current_hash'] = sha256(block_dump).hexdigest()
+        block['current_hash'] = block_hash(block)
         return block    
 
-    def mine_block(self, block):
+    # Returns the winning nonce or None if the mining was interrupted, i.e.,
+    # stop_mining was called or is_active (if given) returned False.
+    # Only the header is searched; the block is not changed until the nonce is found.
+    def mine_block(self, block, is_active=None):
         self.mining_flag = True
-        block_copy = block.copy()   # the original block should not be changed until the nonce is found
-        del block_copy['current_hash']
-        while self.mining_flag:
-            block_dump = str.encode(json.dumps(block_copy, sort_keys=True))
-            hash = sha256(block_dump).hexdigest()
-            if hash[:self.difficulty] == ('0' * self.difficulty):
-                block['nonce'] = block_copy['nonce']
-                block['current_hash'] = hash
-                break
-            block_copy['nonce'] += 1
+        header = block_header(block)
+        active = lambda: self.mining_flag and (is_active is None or is_active())
+        start = time.perf_counter()
+        if self.miner:
+            tried_before = self.total_nonces_tried()
+            result = self.miner.mine(header, self.difficulty, active)
+            tried = self.total_nonces_tried() - tried_before
+        else:
+            counter = [0]
+            result = search(header, self.difficulty, header['nonce'], is_active=active, tried=counter)
+            tried = counter[0]
+            self.nonces_tried += tried
+        elapsed = time.perf_counter() - start
+        self.mining_seconds += elapsed
+        if elapsed > 0:
+            self.hash_rate = tried / elapsed
+        if not result:
+            self.blocks_interrupted += 1
+            return None
+        self.blocks_mined += 1
+        block['nonce'], block['current_hash'] = result
+        return block['nonce']
         
     def stop_mining(self):
         self.mining_flag = False
 
-    # The block hash (current hash) is correct and it begins with the expected number of zeros.
+    # The workers of the miner add their counts after each range of nonces,
+    # so the total lags behind by at most a range per worker.
+    def total_nonces_tried(self):
+        if self.miner and self.miner.nonces_tried:
+            return self.nonces_tried + self.miner.nonces_tried.value
+        return self.nonces_tried
+
+    # The block hash (current hash) is the hash of the header, it begins with the
+    # expected number of zeros and the Merkle root matches the transactions.
     def validate_block_proof(self, block):
         if not block:   # block could be None
             return False
-        block_data = block.copy()
-        del block_data['current_hash']
-        block_dump = str.encode(json.dumps(block_data, sort_keys=True))
-        return sha256(block_dump).hexdigest() == block['current_hash'] and \
-            block['current_hash'][:self.difficulty] == ('0' * self.difficulty)
+        try:
+            return block_hash(block) == block['current_hash'] and \
+                block['current_hash'][:self.difficulty] == ('0' * self.difficulty) and \
+                merkle.root(transactions_json(block)) == block['merkle_root']
+        except (KeyError, TypeError, AttributeError):
+            return False
 
     def validate_block_previous_hash(self, block):
         return block and \
@@ -58,51 +146,150 @@ class Blockchain:
                self.chain[block['previous_hash']]['index'] == block['index'] - 1
 
     def validate_block_transactions(self, block):
-        previous_state = self.states[block['previous_hash']]
-        return block['previous_hash'] in self.states and \
+        previous_state = self.get_state(block['previous_hash'])
+        return previous_state is not None and \
             previous_state.consume_block(block)
 
     def validate_block(self, block):
-        return self.validate_block_proof(block) and \
-            self.validate_block_previous_hash(block) and \
-                self.validate_block_transactions(block)
+        with validation_time.time():
+            return self.validate_block_proof(block) and \
+                self.validate_block_previous_hash(block) and \
+                    self.validate_block_transactions(block)
 
     def add_block(self, block):
-        if self.length == block['index']:
-            self.length += 1
-            self.tail_hash = block['current_hash']
-        self.chain[block['current_hash']] = block
-        if self.length == 1:
+        self.attach(block)
+        if block['index'] == 0:
             previous_state = State()
         else:
-            previous_state = self.states[block['previous_hash']]
-        self.states[block['current_hash']] = previous_state.consume_block(block)
+            previous_state = self.get_state(block['previous_hash'])
+        state = previous_state.consume_block(block)
+        if self.is_checkpoint(block):
+            state.flatten()   # a checkpoint should not keep its parents alive
+        self.states[block['current_hash']] = state
+        self.prune_states()
+        if self.store:
+            self.store.append(block)
+            if self.is_checkpoint(block) and block['current_hash'] == self.tail_hash:
+                self.store.save_snapshot(block['current_hash'], state)
         print('BLOCK ' + str(block['index']) + ' ADDED: ' + str(datetime.now()))
 
+    # Insert the block into the chain and the index without computing its state.
+    # The tail moves to the block if its branch has more cumulative work than
+    # the current main chain.
+    def attach(self, block):
+        hash = block['current_hash']
+        self.chain[hash] = block
+        self.index.add(block, self.block_work)
+        if self.length == 0 or self.index.work[hash] > self.index.work[self.tail_hash]:
+            self.length = block['index'] + 1
+            self.tail_hash = hash
+            self.index.set_tip(self.tail_hash, self.chain)
+
+    # Restore the blockchain from the store. The stored blocks were validated
+    # before they were stored, so only the blocks after the latest snapshot
+    # are replayed (to compute the tail state).
+    def load(self):
+        for block in self.store.load_blocks():
+            self.attach(block)
+        snapshot = self.store.load_snapshot()
+        if snapshot and snapshot[0] in self.chain:
+            hash, state = snapshot
+            self.states[hash] = state
+        if self.length > 0:
+            self.states[self.tail_hash] = self.get_state(self.tail_hash)
+            self.prune_states()
+
+    def is_checkpoint(self, block):
+        return block['index'] % self.checkpoint_interval == 0
+
+    # Drop the states of blocks that are neither recent nor checkpoints.
+    def prune_states(self):
+        oldest_kept = self.length - self.state_retention
+        for hash in list(self.states):
+            block = self.chain[hash]
+            if block['index'] < oldest_kept and not self.is_checkpoint(block):
+                del self.states[hash]
+
+    # The state after the block with the given hash. If it was not kept, it is
+    # rebuilt by replaying the blocks after the nearest kept ancestor.
+    # Returns None for unknown blocks.
+    def get_state(self, hash):
+        replay = []
+        while hash not in self.states:
+            if hash not in self.chain:
+                return None
+            block = self.chain[hash]
+            replay.append(block)
+            if block['index'] == 0:
+                break
+            hash = block['previous_hash']
+        state = self.states[hash] if hash in self.states else State()
+        for block in reversed(replay):
+            state = state.consume_block(block)
+        return state
+
     def tail_state(self):
         if self.length == 0:
             return State()
-        return self.states[self.tail_hash]
+        return self.get_state(self.tail_hash)
 
     def validate_chain(self):
-        hash = self.tail_hash
-        while True:
-            block = self.chain[hash]
-            if block['index'] == 0:
-                return True
-            if not self.validate_block(block):
+        for hash in self.index.hashes_in_range(1, self.length):
+            if not self.validate_block(self.chain[hash]):
                 return False
-            hash = block['previous_hash']
+        return True
+
+    # The block with the given index in the main chain (None if there is none).
+    def block_at(self, height):
+        hash = self.index.hash_at(height)
+        return self.chain[hash] if hash else None
+
+    # The blocks of the main chain with start <= index < end.
+    def blocks_in_range(self, start, end):
+        return [self.chain[hash] for hash in self.index.hashes_in_range(start, end)]
+
+    # The inclusion proof of a transaction of the main chain, searched from the
+    # tail backwards (or in the block at the given height only). Returns None
+    # if the transaction is not found. It runs without the lock of the node, so
+    # the heights are read once and blocks not yet in the index are skipped.
+    def transaction_proof(self, transaction_id, height=None):
+        if height is None:
+            hashes = reversed(self.index.hashes_in_range(0, self.length))
+        else:
+            hashes = self.index.hashes_in_range(height, height + 1) if height >= 0 else []
+        for hash in hashes:
+            block = self.chain.get(hash)
+            if block is None:
+                continue
+            for position, transaction in enumerate(block['transactions']):
+                if transaction.id == transaction_id:
+                    return {
+                        'transaction_json': transaction.jsonfy(),
+                        'header': block_header(block),
+                        'current_hash': block['current_hash'],
+                        'proof': merkle.proof(transactions_json(block), position)
+                    }
+        return None
 
     def last_block_transactions(self):
-        hash = self.tail_hash
-        block = self.chain[hash]
-        transactions = []
-        for transaction_json in block['transactions']:
-            transactions.append(Transaction(transaction_json=transaction_json))
-        return transactions
+        return self.block_transactions(self.chain[self.tail_hash])
+
+    def block_transactions(self, block):
+        return list(block['transactions'])
+
+    # The blocks that left the main chain and the blocks that joined it when
+    # the tail moved from old_tail_hash to the current tail.
+    def main_chain_changes(self, old_tail_hash):
+        left = []
+        hash = old_tail_hash
+        while hash in self.chain and self.index.hash_at(self.chain[hash]['index']) != hash:
+            left.append(self.chain[hash])
+            hash = self.chain[hash]['previous_hash']
+        fork_height = self.chain[hash]['index'] if hash in self.chain else -1
+        joined = self.blocks_in_range(fork_height + 1, self.length)
+        return left, joined
     
     def blocks_are_equivalent(self, block_1, block_2):
         return block_1['previous_hash'] == block_2['previous_hash'] and \
             block_1['index'] == block_2['index'] and \
-            sorted(block_1['transactions']) == sorted(block_2['transactions'])
+            sorted(transactions_json(block_1)) == sorted(transactions_json(block_2))
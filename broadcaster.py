@@ -1,38 +1,109 @@
 import requests
+import wire
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from metrics import registry
+
+post_time = registry.histogram(
+    'noobcash_peer_post_seconds', 'Time to post a message to a peer (including failed posts)', 'peer')
 
 class Broadcaster:
     """
     A helper class for sending messages between nodes.
+
+    Every peer has its own session, i.e., its own pool of keep-alive
+    connections. Broadcasts are sent to all peers concurrently and every
+    request has its own timeout, so a slow peer does not delay the others.
+
+    Messages are sent in the compact binary format (see wire) to the peers
+    that support it if wire_format is 'binary', and as JSON otherwise.
     """
-    def __init__(self):
+    def __init__(self, timeout=5, max_workers=16, wire_format='json'):
         self.targets = []
+        self.wire_formats = {}   # (ip, port) -> formats the peer can decode
+        self.wire_format = wire_format
         self.headers = {'Content-Type': 'application/json'}
+        self.binary_headers = {'Content-Type': wire.MIME_TYPE}
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.sessions = {}
+        self.lock_sessions = Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
 
     # Don't broadcast back to sender's endpoints.
     def add_ring(self, ring, sender_id):
         for id, node in ring.items():
             if id != sender_id:
                 self.targets.append((node['ip'], node['port']))
+                self.wire_formats[(node['ip'], node['port'])] = node.get('wire_formats', ['json'])
+
+    def sends_binary(self, ip, port):
+        return self.wire_format == 'binary' and 'binary' in self.wire_formats.get((ip, port), [])
 
-    def send_post(self, ip, port, payload, endpoint='/'):
-        r = requests.post('http://' + ip + ':' + port + endpoint, headers=self.headers, data=payload)
+    def session(self, ip, port):
+        with self.lock_sessions:
+            if (ip, port) not in self.sessions:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.max_workers)
+                session.mount('http://', adapter)
+                self.sessions[(ip, port)] = session
+            return self.sessions[(ip, port)]
+
+    def send_post(self, ip, port, payload, endpoint='/', headers=None):
+        with post_time.time(ip + ':' + port):
+            r = self.session(ip, port).post('http://' + ip + ':' + port + endpoint,
+                headers=headers or self.headers, data=payload, timeout=self.timeout)
         return r
-    
-    def broadcast_post(self, payload, endpoint='/'):
-        res = []
+
+    # Returns the responses of the targets ('response' is None and 'error' is
+    # set for the targets that could not be reached in time). If wait is False
+    # the requests are sent in the background and nothing is returned.
+    # The binary_payload (if given) is sent instead of the JSON payload to the
+    # peers that receive the binary format.
+    def broadcast_post(self, payload, endpoint='/', wait=True, binary_payload=None):
+        futures = []
         for ip, port in self.targets:
-            r = requests.post('http://' + ip + ':' + port + endpoint, headers=self.headers, data=payload)
-            res.append({'ip':ip, 'port':port, 'response':r})
-        return res
-    
+            if binary_payload is not None and self.sends_binary(ip, port):
+                future = self.executor.submit(
+                    self.send_post, ip, port, binary_payload, endpoint, self.binary_headers)
+            else:
+                future = self.executor.submit(self.send_post, ip, port, payload, endpoint)
+            futures.append((ip, port, future))
+        if not wait:
+            for ip, port, future in futures:
+                future.add_done_callback(self.report_failure)
+            return []
+        return self.collect(futures)
+
 
     def send_get(self, ip, port, endpoint='/'):
-        r = requests.get('http://' + ip + ':' + port + endpoint)
+        r = self.session(ip, port).get('http://' + ip + ':' + port + endpoint,
+            timeout=self.timeout)
         return r
-    
-    def broadcast_get(self, endpoint='/'):
-        res = []
+
+    def broadcast_get(self, endpoint='/', wait=True):
+        futures = []
         for ip, port in self.targets:
-            r = requests.get('http://' + ip + ':' + port + endpoint)
-            res.append({'ip':ip, 'port':port, 'response':r})
+            future = self.executor.submit(self.send_get, ip, port, endpoint)
+            futures.append((ip, port, future))
+        if not wait:
+            for ip, port, future in futures:
+                future.add_done_callback(self.report_failure)
+            return []
+        return self.collect(futures)
+
+    # Nobody waits for the result of a background request, so failures are printed.
+    def report_failure(self, future):
+        if future.exception():
+            print('BROADCAST FAILED: ' + str(future.exception()))
+
+    def collect(self, futures):
+        res = []
+        for ip, port, future in futures:
+            try:
+                res.append({'ip':ip, 'port':port, 'response':future.result()})
+            except requests.exceptions.RequestException as e:
+                res.append({'ip':ip, 'port':port, 'response':None, 'error':str(e)})
         return res
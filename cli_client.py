@@ -106,6 +106,8 @@ if not has_distributed:
 usage = ('Operations:\n'
         ' t <public key file> <amount>\t'
         'Send <amount> NBC to the wallet with public key in <public key file>\n'
+        ' b <payments file>\t\t'
+        'Send many payments, one \'<public key file> <amount>\' per line\n'
         ' view\t\t\t\t'
         'View the transactions in the last block of the chain\n'
         ' balance\t\t\t'
@@ -148,6 +150,46 @@ while True:
         except json.JSONDecodeError:
             print(r.text)
 
+    elif len(cmd) == 2 and cmd[0] == 'b':
+        try:
+            payments = []
+            with open(cmd[1], 'r') as payments_file:
+                for line in payments_file:
+                    if not line.split():
+                        continue
+                    path, amount = line.split()
+                    with open(path, 'r') as pub_file:
+                        payments.append({
+                            "sender_address": wallet.serialize_public_key(),
+                            "recipient_address": pub_file.read(),
+                            "amount": int(amount)
+                        })
+            # Two requests for all the payments: one for the candidates and
+            # one for the signed transactions.
+            payload = json.dumps({ "payments": payments })
+            r = requests.post(home_url + '/candidate-transactions', headers=headers, data=payload)
+            transactions = []
+            for result in r.json():
+                if 'error' in result:
+                    print(result['error'])
+                    continue
+                transaction = Transaction(transaction_json=result['transaction_json'])
+                transaction.sign(wallet)
+                transactions.append(transaction.jsonfy())
+            payload = json.dumps({
+                "transactions": transactions,
+                "is_local": True
+            })
+            r = requests.post(home_url + '/transactions', headers=headers, data=payload)
+            results = r.json()
+            print(str(results.count('Transaction Enqueued')) + ' of ' +
+                str(len(payments)) + ' payments enqueued\n')
+
+        except FileNotFoundError:
+            print('Invalid path!\n')
+        except ValueError:
+            print('Invalid payments file!\n')
+
     elif len(cmd) == 1 and cmd[0] == 'view':
         r = requests.get(home_url + '/view')
         transactions = r.json()
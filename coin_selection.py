@@ -0,0 +1,79 @@
+"""
+Coin selection: which utxos of the sender a new transaction spends.
+
+A strategy takes the utxos of the sender sorted by amount, largest first (see
+State.account_utxos_by_amount), and the amount to send. It returns the utxos
+to spend, whose total covers the amount. The balance of the sender is checked
+beforehand.
+"""
+
+# The most inputs a transaction gets when dust is consolidated.
+MAX_INPUTS = 20
+
+# The most nodes branch and bound visits before it gives up.
+MAX_TRIES = 10000
+
+
+# Spend the largest utxos, i.e., as few inputs as possible.
+def largest_first(utxos, amount):
+    selected = []
+    total = 0
+    for tx in utxos:
+        selected.append(tx)
+        total += tx['amount']
+        if total >= amount:
+            break
+    return selected
+
+
+# Search for utxos whose total is exactly the amount, so that the transaction
+# has no change output and no new utxo is left to the sender. The depth-first
+# search includes the larger utxos first and backtracks from the branches that
+# cannot reach the amount. Falls back to largest first if no exact match is
+# found within MAX_TRIES steps.
+def branch_and_bound(utxos, amount):
+    remaining = [0] * (len(utxos) + 1)   # total of the utxos from i on
+    for i in range(len(utxos) - 1, -1, -1):
+        remaining[i] = remaining[i + 1] + utxos[i]['amount']
+    selected = []   # indexes of the included utxos
+    total = 0
+    i = 0
+    for _ in range(MAX_TRIES):
+        if total == amount:
+            return [utxos[j] for j in selected]
+        if i < len(utxos) and total + remaining[i] >= amount:
+            if total + utxos[i]['amount'] <= amount:
+                selected.append(i)
+                total += utxos[i]['amount']
+            i += 1
+            continue
+        # Dead end: exclude the last included utxo instead.
+        if not selected:
+            break
+        j = selected.pop()
+        total -= utxos[j]['amount']
+        i = j + 1
+    return largest_first(utxos, amount)
+
+
+# Spend the largest utxos and then merge up to MAX_INPUTS of the smallest
+# ones into the change output. Meant for when the node is idle, since the
+# transaction gets bigger but the sender is left with fewer utxos.
+def consolidate(utxos, amount):
+    selected = largest_first(utxos, amount)
+    dust = utxos[len(selected):]
+    extra = max(0, min(MAX_INPUTS - len(selected), len(dust)))
+    return selected + dust[len(dust) - extra:]
+
+
+STRATEGIES = {
+    'largest_first': largest_first,
+    'branch_and_bound': branch_and_bound,
+    'consolidate': consolidate,
+}
+
+
+def strategy(name):
+    if name not in STRATEGIES:
+        raise ValueError('Unknown coin selection strategy: ' + str(name))
+    return STRATEGIES[name]
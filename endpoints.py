@@ -1,9 +1,18 @@
-from flask import Flask, request
+from flask import Flask, jsonify, request
 from node import Node
 from threading import Thread
 import requests
 
 from transaction import Transaction
+from blockchain import block_dict, block_header, parse_block
+from accounts import registry
+import wire
+import metrics
+import tracing
+
+MAX_BLOCKS_PER_REQUEST = 500
+MAX_HEADERS_PER_REQUEST = 2000
+MAX_TRANSACTIONS_PER_REQUEST = 10000
 
 try:
     running_node = Node()
@@ -39,51 +48,178 @@ def candidate_transaction_post():
     amount = req_dict.get('amount')
     return running_node.create_transaction(sender_address, recipient_address, amount)
 
+# Candidate transactions for many payments, e.g., from payment processors
+@app.route('/candidate-transactions', methods=['POST'])
+def candidate_transactions_post():
+    payments = json_list('payments')
+    if payments is None or not all(isinstance(payment, dict) for payment in payments):
+        return 'Expected a list of payments', 400
+    if len(payments) > MAX_TRANSACTIONS_PER_REQUEST:
+        return 'Too many payments', 413
+    return jsonify(running_node.create_transactions(payments))
     
 # Receive transaction
 @app.route('/transaction', methods=['POST'])
 def transaction_post():
+    # Transactions in the binary format are relayed by other nodes.
+    if request.mimetype == wire.MIME_TYPE:
+        try:
+            transaction = wire.decode_transaction(request.get_data())
+        except ValueError as error:
+            return malformed(error)
+        return running_node.commit_transaction(transaction, False)
     req_dict = request.get_json()
     transaction_json = req_dict.get('transaction_json')
     is_local = req_dict.get('is_local')
     transaction = Transaction(transaction_json=transaction_json)
     return running_node.commit_transaction(transaction, is_local)
 
+# Receive a batch of transactions relayed by another node or signed by a
+# client (is_local). The result of every transaction is sent back.
+@app.route('/transactions', methods=['POST'])
+def transactions_post():
+    if request.mimetype == wire.MIME_TYPE:
+        try:
+            transactions = wire.decode_transactions(request.get_data())
+        except ValueError as error:
+            return malformed(error)
+        if len(transactions) > MAX_TRANSACTIONS_PER_REQUEST:
+            return 'Too many transactions', 413
+        return jsonify(running_node.commit_transactions(transactions))
+    transactions_json = json_list('transactions')
+    if transactions_json is None or \
+        not all(transaction_json and isinstance(transaction_json, str) for transaction_json in transactions_json):
+        return 'Expected a list of transactions', 400
+    if len(transactions_json) > MAX_TRANSACTIONS_PER_REQUEST:
+        return 'Too many transactions', 413
+    try:
+        transactions = [Transaction(transaction_json=transaction_json)
+            for transaction_json in transactions_json]
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return 'Malformed transaction', 400
+    return jsonify(running_node.commit_transactions(transactions, request.get_json().get('is_local')))
+
+# The list in the given field of the JSON body (None if there is none).
+def json_list(field):
+    req_dict = request.get_json(silent=True)
+    value = req_dict.get(field) if isinstance(req_dict, dict) else None
+    return value if isinstance(value, list) else None
+
 
 # CLI client
 # Send transactions in last block
 @app.route('/view')
 def view_get():
-    transactions_list = running_node.blockchain.last_block_transactions()
+    tail_block = running_node.snapshot.tail_block
+    if not tail_block:
+        return {}
+    transactions_list = running_node.blockchain.block_transactions(tail_block)
     res = {}
     for trans in transactions_list:
         res[trans.id] = {
             'from': trans.data['sender_address'],
-            'to': trans.data['receiver_address'],
+            'to': registry.public_key(trans.data['receiver_address']) or trans.data['receiver_address'],
             'amount': trans.data['amount']} 
     return res
 
-# Send balance of node
+# Send balance of node (from the published snapshot, without waiting for
+# the blocks being added)
 @app.route('/balance', methods=['POST'])
 def balance_get():
     user_address = request.get_json().get('user_address')
-    return str(running_node.current_state.get_balance(user_address)) + str(' NBC')
+    return str(running_node.snapshot.state.get_balance(user_address)) + str(' NBC')
 
 
 # Receive block
 @app.route('/block', methods=['POST'])
 def block_post():
-    foreign_block = request.get_json()
+    if request.mimetype == wire.MIME_TYPE:
+        try:
+            foreign_block = wire.decode_block(request.get_data())
+        except ValueError as error:
+            return malformed(error)
+    else:
+        foreign_block = parse_block(request.get_json())
     return running_node.get_block(foreign_block)
 
 
+# Send the block with the given index in the main chain
+@app.route('/block/<int:height>')
+def block_get(height):
+    block = running_node.blockchain.block_at(height)
+    if not block:
+        return '', 404
+    return block_dict(block)
+
+# Send the blocks of the main chain with start <= index < end
+@app.route('/blocks')
+def blocks_get():
+    start = request.args.get('start', 0, type=int)
+    end = request.args.get('end', running_node.blockchain.length, type=int)
+    end = min(end, start + MAX_BLOCKS_PER_REQUEST)
+    return jsonify([block_dict(block)
+        for block in running_node.blockchain.blocks_in_range(start, end)])
+
+
+# Send the headers of the blocks of the main chain with start <= index < end,
+# e.g., to light clients that verify payments with Merkle proofs
+@app.route('/headers')
+def headers_get():
+    start = request.args.get('start', 0, type=int)
+    end = request.args.get('end', running_node.blockchain.length, type=int)
+    end = min(end, start + MAX_HEADERS_PER_REQUEST)
+    return jsonify([dict(block_header(block), current_hash=block['current_hash'])
+        for block in running_node.blockchain.blocks_in_range(start, end)])
+
+# Send the Merkle inclusion proof of a transaction of the main chain. The
+# height of its block can be given to skip the search.
+@app.route('/merkle-proof/<transaction_id>')
+def merkle_proof_get(transaction_id):
+    height = request.args.get('height', type=int)
+    proof = running_node.blockchain.transaction_proof(transaction_id, height)
+    if not proof:
+        return '', 404
+    return proof
+
+# Send the metrics of the node in the Prometheus text format.
+@app.route('/metrics')
+def metrics_get():
+    return metrics.registry.exposition(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+
+# Send the stamps of a transaction on this node (see tracing). With peers=1
+# the stamps of all the nodes are merged, in time order.
+@app.route('/trace/<transaction_id>')
+def trace_get(transaction_id):
+    traces = [running_node.tracer.trace(transaction_id)]
+    if request.args.get('peers', 0, type=int):
+        for res in running_node.broadcaster.broadcast_get('/trace/' + transaction_id):
+            if res['response'] is not None and res['response'].status_code == 200:
+                try:
+                    traces.append(res['response'].json())
+                except ValueError:   # not a trace, e.g., a peer without tracing endpoints
+                    pass
+    return jsonify(tracing.merge(traces))
+
+# Send all the stamps kept in memory as JSON lines (the format of TRACE_FILE).
+@app.route('/traces')
+def traces_get():
+    return running_node.tracer.export(), 200, {'Content-Type': 'application/x-ndjson'}
+
+
+# Response to a binary message that cannot be decoded
+def malformed(error):
+    return 'Malformed message: ' + str(error), 400
+
+
 # Initial registration request to bootstrap
 @app.route('/registration', methods=['POST'])
 def registration_get():
     # Bootstrap stores ip,port and returns ID.
     ip = request.remote_addr                    # ip address can be found from the request
     port = request.get_json().get('port')       # port is sent
-    running_node.store_node(ip, port)
+    wire_formats = request.get_json().get('wire_formats')
+    running_node.store_node(ip, port, wire_formats)
     res = {}
     res['node_id'] = running_node.give_id()
     return res
@@ -110,7 +246,7 @@ def ring_post():
 
 @app.route('/make-genesis', methods=['POST'])
 def make_genesis_get():
-    if not running_node.is_bootstrap or not running_node.current_state.empty():
+    if not running_node.is_bootstrap or running_node.snapshot.length > 0:
         return '', 405
     original_public_key = request.get_json().get('original_public_key')
     return running_node.make_genesis_block(original_public_key)
@@ -0,0 +1,162 @@
+import time
+from collections import OrderedDict
+from threading import Condition
+from accounts import account_id
+from state import utxo
+
+class Mempool:
+    """
+    The transactions waiting to be placed in a block.
+
+    Only transactions whose signature was verified may be added (the id does
+    not cover the signature, so an unverified copy could claim the inputs or
+    the id of a genuine transaction). Rejected transactions are remembered by
+    id and signature for the same reason.
+
+    Transactions are indexed by id and by the inputs they spend, so that a
+    duplicate is rejected and a double spend is detected as soon as it is
+    added. A transaction stays in the indexes from the moment it is added
+    until it is included in a block (or found invalid), even after the
+    processing thread has taken it.
+    """
+    def __init__(self, max_size=100000, max_rejected=10000):
+        self.max_size = max_size
+        self.max_rejected = max_rejected
+        self.waiting = OrderedDict()   # id -> transaction, not yet taken, in arrival order
+        self.pending = {}              # id -> transaction, waiting or taken
+        self.spent = {}                # (sender account id, input id) -> id of the spending transaction
+        self.rejected = OrderedDict()  # (id, signature) -> reason, for the most recently rejected transactions
+        self.arrivals = {}             # id -> time.monotonic() when the transaction was added
+        self.change = {}               # sender account id -> {id: change utxo of a pending transaction}
+        self.condition = Condition()
+        self.interrupted = False
+
+    def __len__(self):
+        return len(self.waiting)
+
+    def inputs(self, transaction):
+        sender = account_id(transaction.data['sender_address'])
+        return [(sender, input_id) for input_id in transaction.data['input_txs']]
+
+    # Returns 'Transaction Enqueued' or the reason the transaction was rejected.
+    def add(self, transaction):
+        with self.condition:
+            return self.insert(transaction)
+
+    # Add many transactions while holding the lock once.
+    def add_many(self, transactions):
+        with self.condition:
+            return [self.insert(transaction) for transaction in transactions]
+
+    def insert(self, transaction):
+        if transaction.id in self.pending:
+            return 'Duplicate transaction'
+        reason = self.rejected.get((transaction.id, transaction.signature))
+        if reason:
+            return 'Transaction rejected: ' + reason
+        if len(self.pending) >= self.max_size:
+            return 'Mempool full'
+        inputs = self.inputs(transaction)
+        for spent_input in inputs:
+            if spent_input in self.spent:
+                self.reject(transaction, 'Double spend')
+                return 'Double spend! Input already spent by a pending transaction'
+        for spent_input in inputs:
+            self.spent[spent_input] = transaction.id
+        self.pending[transaction.id] = transaction
+        self.waiting[transaction.id] = transaction
+        self.arrivals[transaction.id] = time.monotonic()
+        if len(transaction.output_txs) > 1:
+            sender = inputs[0][0] if inputs else account_id(transaction.data['sender_address'])
+            self.change.setdefault(sender, {})[transaction.id] = \
+                utxo(transaction.output_txs[1], sender)
+        self.condition.notify()
+        return 'Transaction Enqueued'
+
+    # Take the oldest waiting transaction. Returns None if none arrives within
+    # timeout seconds or if the wait is interrupted.
+    def get(self, timeout=None):
+        with self.condition:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self.waiting and not self.interrupted:
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    self.condition.wait(remaining)
+            self.interrupted = False
+            if not self.waiting:
+                return None
+            return self.waiting.popitem(last=False)[1]
+
+    # Wake up the thread waiting in get, e.g., because the block it assembles
+    # must be rebuilt.
+    def interrupt(self):
+        with self.condition:
+            self.interrupted = True
+            self.condition.notify_all()
+
+    # Whether an input of the sender is spent by a pending transaction.
+    def is_spent(self, sender_id, input_id):
+        return (sender_id, input_id) in self.spent
+
+    # The change utxos of the pending transactions of the sender, largest
+    # amount first. A new transaction of the sender may spend them; it is
+    # placed in a block after the transaction it spends from.
+    def pending_change(self, sender_id):
+        with self.condition:
+            return sorted(self.change.get(sender_id, {}).values(),
+                key=lambda tx: tx['amount'], reverse=True)
+
+    # When the transaction was added (now, if it is not pending).
+    def arrival(self, transaction_id):
+        return self.arrivals.get(transaction_id, time.monotonic())
+
+    # Forget a transaction that turned out to be invalid.
+    def discard(self, transaction, reason='Invalid transaction'):
+        with self.condition:
+            self.forget(transaction.id)
+            self.reject(transaction, reason)
+
+    # Returns the forgotten transaction (None if it was not pending).
+    def forget(self, transaction_id):
+        transaction = self.pending.pop(transaction_id, None)
+        if not transaction:
+            return None
+        self.waiting.pop(transaction_id, None)
+        self.arrivals.pop(transaction_id, None)
+        sender = account_id(transaction.data['sender_address'])
+        sender_change = self.change.get(sender)
+        if sender_change is not None:
+            sender_change.pop(transaction_id, None)
+            if not sender_change:
+                del self.change[sender]
+        for spent_input in self.inputs(transaction):
+            if self.spent.get(spent_input) == transaction_id:
+                del self.spent[spent_input]
+        return transaction
+
+    def reject(self, transaction, reason):
+        self.rejected[(transaction.id, transaction.signature)] = reason
+        if len(self.rejected) > self.max_rejected:
+            self.rejected.popitem(last=False)
+
+    # Evict the transactions of a block that was added to the main chain, as
+    # well as the pending transactions that conflict with them.
+    def remove_included(self, transactions):
+        with self.condition:
+            for transaction in transactions:
+                self.forget(transaction.id)
+                for spent_input in self.inputs(transaction):
+                    conflicting = self.spent.get(spent_input)
+                    if conflicting:
+                        self.reject(self.forget(conflicting), 'Double spend')
+
+    # Put back the transactions of blocks that left the main chain.
+    def reinject(self, transactions):
+        with self.condition:
+            for transaction in transactions:
+                self.rejected.pop((transaction.id, transaction.signature), None)
+                self.insert(transaction)
@@ -0,0 +1,64 @@
+"""
+Merkle tree of the transactions of a block.
+
+The leaves are the SHA-256 digests of the transaction JSON strings, in block
+order. Every inner node is the digest of its two children; the last node of a
+level with an odd number of nodes is carried up unchanged. The root is part
+of the block header, so the proof-of-work commits to the transactions while
+only the header is hashed for every nonce.
+"""
+from hashlib import sha256
+
+
+def leaf(transaction_json):
+    return sha256(transaction_json.encode()).digest()
+
+
+# All the levels of the tree, from the leaves up to the root.
+def levels(transactions_json):
+    level = [leaf(transaction_json) for transaction_json in transactions_json]
+    tree = [level]
+    while len(level) > 1:
+        next_level = [sha256(level[i] + level[i + 1]).digest()
+            for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+        tree.append(level)
+    return tree
+
+
+# The hex root of the tree (the digest of no data for a block with no
+# transactions).
+def root(transactions_json):
+    if not transactions_json:
+        return sha256(b'').hexdigest()
+    return levels(transactions_json)[-1][0].hex()
+
+
+# The inclusion proof of the transaction at the given position: the sibling
+# of every node on the path from its leaf to the root, bottom up, e.g.
+# [{'hash': '5f1c..', 'side': 'left'}, {'hash': '09ab..', 'side': 'right'}]
+def proof(transactions_json, position):
+    path = []
+    for level in levels(transactions_json)[:-1]:
+        sibling = position ^ 1
+        if sibling < len(level):
+            path.append({
+                'hash': level[sibling].hex(),
+                'side': 'left' if sibling < position else 'right'
+            })
+        position //= 2
+    return path
+
+
+# Whether the proof leads from the transaction to the root.
+def verify(transaction_json, path, merkle_root):
+    node = leaf(transaction_json)
+    for step in path:
+        sibling = bytes.fromhex(step['hash'])
+        if step['side'] == 'left':
+            node = sha256(sibling + node).digest()
+        else:
+            node = sha256(node + sibling).digest()
+    return node.hex() == merkle_root
@@ -0,0 +1,185 @@
+"""
+Metrics of the node in the Prometheus text format (see the /metrics endpoint).
+
+Counters and histograms are updated on the hot paths, so an update is a few
+additions under a lock. Values that are kept anyway (e.g., the size of the
+mempool or the counters of the verifier) are read by callbacks only when the
+metrics are collected.
+"""
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from threading import Lock
+
+# Upper bounds (in seconds) of the buckets of the timing histograms.
+TIME_BUCKETS = [0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"'
+        for name, value in labels) + '}'
+
+
+class Counter:
+    """
+    A value that only goes up. If a function is given, the value is read
+    from it when the metrics are collected.
+    """
+    type = 'counter'
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.value = 0
+        self.lock = Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        value = self.function() if self.function else self.value
+        return [(self.name, [], value)]
+
+
+class Gauge(Counter):
+    """
+    A value that goes up and down, e.g., the size of a queue.
+    """
+    type = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+
+class Timer:
+    def __init__(self, histogram, label_value):
+        self.histogram = histogram
+        self.label_value = label_value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.histogram.observe(time.perf_counter() - self.start, self.label_value)
+
+
+class Histogram:
+    """
+    Counts the observed values (e.g., durations in seconds) per bucket. The
+    values may be split into series by the value of one label (e.g., peer).
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help, label=None, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.series = {}   # label value -> [counts per bucket, sum, count]
+        self.lock = Lock()
+
+    def observe(self, value, label_value=None):
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_value)
+            if series is None:
+                series = self.series[label_value] = [[0] * (len(self.buckets) + 1), 0, 0]
+            series[0][bucket] += 1
+            series[1] += value
+            series[2] += 1
+
+    # Observe the duration of a with block.
+    def time(self, label_value=None):
+        return Timer(self, label_value)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            series = [(label_value, list(counts), total, count)
+                for label_value, (counts, total, count) in self.series.items()]
+        for label_value, counts, total, count in sorted(series, key=lambda s: str(s[0])):
+            labels = [(self.label, label_value)] if self.label else []
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ['+Inf'], counts):
+                cumulative += bucket_count
+                samples.append((self.name + '_bucket', labels + [('le', bound)], cumulative))
+            samples.append((self.name + '_sum', labels, total))
+            samples.append((self.name + '_count', labels, count))
+        return samples
+
+
+class TimedLock:
+    """
+    A lock that observes how long the threads wait for it and how long they
+    hold it. It can be used by a Condition.
+    """
+    def __init__(self, wait_time, hold_time):
+        self.lock = Lock()
+        self.wait_time = wait_time
+        self.hold_time = hold_time
+        self.acquired_at = None
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not blocking:
+            return self.lock.acquire(False)
+        start = time.perf_counter()
+        acquired = self.lock.acquire(True, timeout)
+        if acquired:
+            self.acquired_at = time.perf_counter()
+            self.wait_time.observe(self.acquired_at - start)
+        return acquired
+
+    def release(self):
+        acquired_at = self.acquired_at
+        self.acquired_at = None
+        self.lock.release()
+        if acquired_at is not None:
+            self.hold_time.observe(time.perf_counter() - acquired_at)
+
+    def locked(self):
+        return self.lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *exception):
+        self.release()
+
+
+class Registry:
+    """
+    The metrics of the node, by name. A metric registered again replaces the
+    previous one.
+    """
+    def __init__(self):
+        self.metrics = OrderedDict()
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, function=None):
+        return self.register(Counter(name, help, function))
+
+    def gauge(self, name, help, function=None):
+        return self.register(Gauge(name, help, function))
+
+    def histogram(self, name, help, label=None, buckets=TIME_BUCKETS):
+        return self.register(Histogram(name, help, label, buckets))
+
+    def exposition(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append('# HELP ' + metric.name + ' ' + metric.help)
+            lines.append('# TYPE ' + metric.name + ' ' + metric.type)
+            for name, labels, value in metric.samples():
+                lines.append(name + format_labels(labels) + ' ' + repr(float(value)))
+        return '\n'.join(lines) + '\n'
+
+
+# Shared by the whole node.
+registry = Registry()
@@ -0,0 +1,147 @@
+import json
+import multiprocessing
+from hashlib import sha256
+from itertools import count
+from queue import Empty
+
+# Number of consecutive nonces a worker tries before moving on to its next
+# range. Worker i handles the ranges i, i + workers, i + 2 * workers, ...
+RANGE_SIZE = 1 << 16
+
+# How often (in nonces) the search loop checks whether it should keep going.
+CHECK_INTERVAL = 256
+
+# How long (in seconds) the main thread waits for a result before checking
+# whether the mining was stopped.
+POLL_INTERVAL = 0.05
+
+
+# The block header is serialized once as prefix + nonce + suffix, exactly as
+# json.dumps(block_data, sort_keys=True) would serialize it for any nonce.
+def layout(block_data):
+    block_dump = json.dumps(dict(block_data, nonce=0), sort_keys=True)
+    marker = '"nonce": '
+    position = block_dump.index(marker) + len(marker)
+    prefix = str.encode(block_dump[:position])
+    suffix = str.encode(block_dump[position + 1:])   # skip the placeholder 0
+    return prefix, suffix
+
+
+# A hex digest begins with difficulty zeros iff the digest (as a big endian
+# number) is at most this target. Byte strings of equal length compare the same way.
+def target(difficulty):
+    return (16 ** (64 - difficulty) - 1).to_bytes(32, 'big')
+
+
+# Try the nonces in [start, stop) (stop=None means no upper bound) and return
+# (nonce, hash) for the first one that solves the proof-of-work problem.
+# Returns None if the range is exhausted or is_active() becomes False.
+# The constant prefix of the header is hashed once and its sha256 state is
+# copied for every nonce. The number of nonces tried is added to tried[0].
+def search(block_data, difficulty, start, stop=None, is_active=None, tried=None):
+    prefix, suffix = layout(block_data)
+    prefix_state = sha256(prefix)
+    limit = target(difficulty)
+    nonces = count(start) if stop is None else range(start, stop)
+    result = None
+    nonce = start
+    for nonce in nonces:
+        if is_active and nonce % CHECK_INTERVAL == 0 and not is_active():
+            break
+        state = prefix_state.copy()
+        state.update(b'%d' % nonce)
+        state.update(suffix)
+        if state.digest() <= limit:
+            result = nonce, state.hexdigest()
+            nonce += 1
+            break
+    else:
+        nonce = stop
+    if tried is not None:
+        tried[0] += nonce - start
+    return result
+
+
+# Worker process loop. Jobs are identified by increasing ids; a worker keeps
+# searching its share of the nonce space for as long as its job is the active one.
+def work(worker_id, workers, jobs, results, active_job, nonces_tried):
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        job_id, block_data, difficulty = job
+        is_active = lambda: active_job.value == job_id
+        round = 0
+        while is_active():
+            start = (round * workers + worker_id) * RANGE_SIZE
+            tried = [0]
+            result = search(block_data, difficulty, start, start + RANGE_SIZE, is_active, tried)
+            with nonces_tried.get_lock():
+                nonces_tried.value += tried[0]
+            if result:
+                results.put((job_id, result[0], result[1]))
+                break
+            round += 1
+
+
+class Miner:
+    """
+    A pool of worker processes that search disjoint ranges of the nonce space
+    in parallel. The processes are started on first use and are reused for
+    every block.
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.context = multiprocessing.get_context('spawn')
+        self.processes = []
+        self.jobs = []
+        self.results = None
+        self.active_job = None
+        self.nonces_tried = None   # by all the workers, since they were started
+
+    def start(self):
+        if self.processes:
+            return
+        self.results = self.context.Queue()
+        self.active_job = self.context.Value('q', 0)
+        self.nonces_tried = self.context.Value('q', 0)
+        for worker_id in range(self.workers):
+            jobs = self.context.Queue()
+            process = self.context.Process(
+                target=work,
+                args=(worker_id, self.workers, jobs, self.results, self.active_job, self.nonces_tried),
+                daemon=True)
+            process.start()
+            self.jobs.append(jobs)
+            self.processes.append(process)
+
+    # Search for a nonce until one is found or is_active() becomes False.
+    # Returns (nonce, hash) or None if the mining was stopped.
+    def mine(self, block_data, difficulty, is_active):
+        self.start()
+        with self.active_job.get_lock():
+            self.active_job.value += 1
+            job_id = self.active_job.value
+        for jobs in self.jobs:
+            jobs.put((job_id, block_data, difficulty))
+        try:
+            while is_active():
+                try:
+                    found_job, nonce, hash = self.results.get(timeout=POLL_INTERVAL)
+                except Empty:
+                    continue
+                if found_job == job_id:   # results of older jobs are discarded
+                    return nonce, hash
+            return None
+        finally:
+            # Make the workers abandon this job.
+            with self.active_job.get_lock():
+                self.active_job.value += 1
+
+    def stop(self):
+        for jobs in self.jobs:
+            jobs.put(None)
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        self.jobs = []
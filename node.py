@@ -1,14 +1,37 @@
 from transaction import Transaction
 from broadcaster import Broadcaster
-from blockchain import Blockchain
-from state import State
+from batcher import TransactionBatcher
+from mempool import Mempool
+from blockchain import Blockchain, block_dict
+from state import State, utxo
+from verifier import verifier
+from storage import BlockStore
+from sync import ChainSync
+from snapshot import Snapshot
+from reservations import Reservations
+import coin_selection
+from metrics import registry, TimedLock
+from tracing import Tracer
+from accounts import account_id
+import wire
+import heapq
 import json
+import time
 from os import environ
-from threading import Lock
-from queue import Empty, Queue
+from collections import deque
+from threading import Condition, Thread
+
+lock_wait_time = registry.histogram(
+    'noobcash_state_lock_wait_seconds', 'Time spent waiting for the lock of the current state')
+lock_hold_time = registry.histogram(
+    'noobcash_state_lock_hold_seconds', 'Time the lock of the current state is held')
+stale_blocks = registry.counter(
+    'noobcash_stale_blocks_total', 'Mined blocks discarded because the tail moved while mining')
 
 class Node:
-    def __init__(self):
+    # The broadcaster can be given, e.g., to run many nodes in one process
+    # (see benchmarks/cluster.py).
+    def __init__(self, broadcaster=None):
         self.number_of_nodes = environ['NUMBER_OF_NODES']
         self.difficulty = int(environ['DIFFICULTY'])
         self.bootstrap_ip = environ['BOOTSTRAP_IP']
@@ -16,6 +39,30 @@ class Node:
         self.node_port = environ['NODE_PORT']
         self.capacity = int(environ['CAPACITY'])
         self.total_coins = int(environ['TOTAL_COINS'])
+        self.mining_workers = int(environ.get('MINING_WORKERS', 1))
+        self.state_retention = int(environ.get('STATE_RETENTION', 100))
+        self.checkpoint_interval = int(environ.get('CHECKPOINT_INTERVAL', 100))
+        self.verify_workers = int(environ.get('VERIFY_WORKERS', 1))
+        self.broadcast_timeout = float(environ.get('BROADCAST_TIMEOUT', 5))
+        self.batch_size = int(environ.get('BATCH_SIZE', 100))
+        self.batch_delay = float(environ.get('BATCH_DELAY', 5)) / 1000   # milliseconds
+        self.data_dir = environ.get('DATA_DIR')   # the chain is kept in memory only if unset
+        self.sync_batch_size = int(environ.get('SYNC_BATCH_SIZE', 50))
+        self.wire_format = environ.get('WIRE_FORMAT', 'json')   # format used to send to peers
+        self.wire_formats = ['json', 'binary']   # formats this node can receive
+        self.mempool_size = int(environ.get('MEMPOOL_SIZE', 100000))
+        self.block_max_latency = float(environ.get('BLOCK_MAX_LATENCY', 4))   # seconds
+        self.max_block_size = int(environ.get('MAX_BLOCK_SIZE', 1000000))     # bytes of transactions
+        self.mining_pipeline = int(environ.get('MINING_PIPELINE', 2))   # sealed blocks waiting to be mined
+        # Which utxos new transactions spend, when the mempool has waiting
+        # transactions and when it is idle (see coin_selection).
+        self.select_coins = coin_selection.strategy(environ.get('COIN_SELECTION', 'branch_and_bound'))
+        self.select_coins_idle = coin_selection.strategy(environ.get('IDLE_COIN_SELECTION', 'consolidate'))
+        self.reservation_ttl = float(environ.get('RESERVATION_TTL', 60))   # seconds
+        # Stamp every transaction at each stage (see tracing), optionally to a file.
+        self.tracing = environ.get('TRACING', '0') == '1'
+        self.trace_file = environ.get('TRACE_FILE')
+        self.trace_size = int(environ.get('TRACE_SIZE', 10000))   # transactions kept in memory
 
         self.ring = {}
         """
@@ -28,20 +75,45 @@ class Node:
             },
             '1': {
                 'ip':'127.0.0.1',
-                'port':'5001'
+                'port':'5001',
+                'wire_formats':['json', 'binary']
             },
         }
         """
 
-        self.blockchain = Blockchain(self.difficulty)
+        self.blockchain = Blockchain(
+            self.difficulty,
+            self.mining_workers,
+            self.state_retention,
+            self.checkpoint_interval,
+            BlockStore(self.data_dir) if self.data_dir else None)
         self.current_state = State()
-        self.broadcaster = Broadcaster()
-        self.lock_current_state = Lock()
-        self.transactions_queue = Queue()
+        self.snapshot = Snapshot()   # read by the queries without lock_current_state
+        self.broadcaster = broadcaster or \
+            Broadcaster(timeout=self.broadcast_timeout, wire_format=self.wire_format)
+        self.tracer = Tracer(self.tracing, self.trace_file, self.trace_size)
+        self.batcher = TransactionBatcher(self.broadcaster, self.batch_size, self.batch_delay, self.tracer)
+        verifier.set_workers(self.verify_workers)
+        self.lock_current_state = TimedLock(lock_wait_time, lock_hold_time)
+        # Signals the mining thread and the processing thread that the sealed
+        # blocks or the tail changed.
+        self.mining_ready = Condition(self.lock_current_state)
+        self.mempool = Mempool(self.mempool_size)
+        self.reservations = Reservations(self.reservation_ttl)
+        self.sync = ChainSync(self, self.sync_batch_size)
         self.has_distributed = False
 
-        self.mining_transactions = []
+        self.mining_transactions = []   # the block being assembled
         self.mining_state = State()
+        self.sealed = deque()     # transaction lists of the blocks waiting to be mined, in order
+        self.mining_base = None   # the tail hash the first sealed block (or the mining state) extends
+        self.mining_size = 0      # bytes of the transactions acquired thus far
+        self.mining_deadline = None   # when the block must be mined (time.monotonic())
+
+        self.register_metrics()
+
+        if self.blockchain.store:
+            self.restore()
 
         if not self.node_port:
             self.is_bootstrap = True
@@ -50,27 +122,72 @@ class Node:
             self.next_id = '1'
             self.ring['0'] = {
                 'ip':self.bootstrap_ip, 
-                'port':self.bootstrap_port
+                'port':self.bootstrap_port,
+                'wire_formats':self.wire_formats
             }
 
         else:
             self.is_bootstrap = False
             # Initially, nodes send a registration request to the bootstrap and
             # store the answer, which contains their ID.
-            payload = json.dumps({ "port": self.node_port })
+            payload = json.dumps({
+                "port": self.node_port,
+                "wire_formats": self.wire_formats
+            })
             r = self.broadcaster.send_post(
                     ip=self.bootstrap_ip,
                     port=self.bootstrap_port,
                     payload=payload,
                     endpoint='/registration')
             self.node_id = r.json().get('node_id')
+        self.tracer.node_id = self.node_id
+
+
+    # The values the node keeps anyway are read when the metrics are collected.
+    def register_metrics(self):
+        blockchain = self.blockchain
+        registry.gauge('noobcash_chain_length', 'Blocks in the main chain',
+            lambda: self.snapshot.length)
+        registry.gauge('noobcash_mempool_waiting', 'Transactions waiting to be placed in a block',
+            lambda: len(self.mempool))
+        registry.gauge('noobcash_mempool_pending', 'Transactions not yet included in a block',
+            lambda: len(self.mempool.pending))
+        registry.gauge('noobcash_sealed_blocks', 'Sealed blocks waiting to be mined',
+            lambda: len(self.sealed))
+        registry.counter('noobcash_blocks_mined_total', 'Blocks mined by this node',
+            lambda: blockchain.blocks_mined)
+        registry.counter('noobcash_mining_interrupted_total', 'Minings stopped before a nonce was found',
+            lambda: blockchain.blocks_interrupted)
+        registry.counter('noobcash_mining_seconds_total', 'Time spent mining',
+            lambda: blockchain.mining_seconds)
+        registry.counter('noobcash_nonces_tried_total', 'Nonces tried by the miner',
+            blockchain.total_nonces_tried)
+        registry.gauge('noobcash_hash_rate', 'Hashes per second of the last mining',
+            lambda: blockchain.hash_rate)
+        for key in ['verifications', 'signature_cache_hits', 'signature_cache_misses',
+            'key_cache_hits', 'key_cache_misses']:
+            registry.counter('noobcash_verifier_' + key + '_total', 'Signature verifier ' + key.replace('_', ' '),
+                lambda key=key: verifier.stats()[key])
+
+    # Load the blockchain stored by a previous run of the node.
+    def restore(self):
+        start = time.perf_counter()
+        self.blockchain.load()
+        self.publish()
+        self.mining_state = State(initial_state=self.current_state)
+        print('CHAIN RESTORED: ' + str(self.blockchain.length) + ' blocks in ' +
+            str(round(time.perf_counter() - start, 3)) + ' s')
 
 
     # BOOTSTRAP
     # Initially each node registers to the bootstrap to get an ID.
     # The bootstrap must store the node's ip, port before returning the ID.
-    def store_node(self, ip, port):
-        self.ring[self.next_id] = {'ip': ip, 'port': port}
+    def store_node(self, ip, port, wire_formats=None):
+        self.ring[self.next_id] = {
+            'ip': ip,
+            'port': port,
+            'wire_formats': wire_formats or ['json']
+        }
 
     # BOOTSTRAP
     # The bootstrap must keep track of the assigned IDs.
@@ -95,7 +212,7 @@ class Node:
         # Create the initial transaction with 'special' sender. 
         initial_transaction = Transaction(
             sender_address='0',
-            recipient_address=original_public_key,
+            recipient_address=account_id(original_public_key),
             amount=self.total_coins,
             spent_txs=[{
                 'id': 'FromWhichTransactionDidSender0GetTheseNBS',
@@ -113,14 +230,13 @@ class Node:
         
         # Update the state and the blockchain.
         self.blockchain.add_block(gen_block)
-        self.current_state = self.blockchain.tail_state()
+        self.publish()
         self.mining_state = State(initial_state=self.current_state)
 
         self.lock_current_state.release()
 
         # Broadcast the genesis block.
-        payload = json.dumps(gen_block)
-        self.broadcaster.broadcast_post(payload, endpoint='/block')
+        self.broadcast_block(gen_block)
         return 'Genesis block broadcasted'
 
 
@@ -133,122 +249,348 @@ class Node:
     
 
     # The transaction is created based on the state of the last block in the chain.
-    # Then it is sent back to the client for signing.
+    # Then it is sent back to the client for signing. The recipient is referred
+    # to by account id; only the sender's public key is needed in the transaction.
+    # The state is read from the published snapshot, without lock_current_state.
+    # The sender may also spend the change of its pending transactions and
+    # candidates, so a sender can make many payments before they are included
+    # in a block (the transactions must be committed in order). The
+    # utxos spent by pending transactions or reserved by other candidates are
+    # not spent, and the utxos of the new candidate are reserved until it is
+    # committed.
     def create_transaction(self, sender_address, recipient_address, amount):
-        self.lock_current_state.acquire()
+        transaction, error = self.create_candidate(sender_address, recipient_address, amount)
+        return error or transaction.jsonfy()
+
+    # Many candidates in one go. Returns a result for every payment: the
+    # candidate transaction or the reason it was not created. If the batch
+    # fails, the candidates created thus far are dropped.
+    def create_transactions(self, payments):
+        results = []
+        created = []
+        try:
+            for payment in payments:
+                transaction, error = self.create_candidate(
+                    payment.get('sender_address'),
+                    payment.get('recipient_address'),
+                    payment.get('amount'),
+                    created)
+                if error:
+                    results.append({'error': error})
+                else:
+                    created.append(transaction.id)
+                    results.append({'transaction_json': transaction.jsonfy()})
+        except Exception:
+            for transaction_id in created:
+                self.reservations.release(transaction_id, committed=False)
+            raise
+        return results
+
+    # Returns the candidate transaction and None, or None and the reason it
+    # cannot be created. Besides the confirmed utxos and the change of pending
+    # transactions, the candidate may spend the change of the earlier
+    # candidates of its batch (ids), which the client signs together.
+    def create_candidate(self, sender_address, recipient_address, amount, batch=()):
         # Check request parameters
-        if not self.current_state.check_balance(sender_address, amount):
-            self.lock_current_state.release()
-            return 'Not enough coins! Aborting transaction...'
-        if sender_address == recipient_address:
-            self.lock_current_state.release()
-            return "Cannot send coins to one's own wallet! Aborting transaction..."
-
-        # Find utxos to spend 
-        spent_txs = []
-        total = 0
-        for tx in self.current_state.utxos[sender_address].values():
-            total += tx['amount']
-            spent_txs.append(tx)
-            if total >= amount:
-                break
-
-        transaction = Transaction(
-            sender_address=sender_address,
-            recipient_address=recipient_address,
-            amount=amount,
-            spent_txs=spent_txs)
+        if not isinstance(sender_address, str) or not isinstance(recipient_address, str):
+            return None, 'Invalid address! Aborting transaction...'
+        if not isinstance(amount, int) or isinstance(amount, bool):
+            return None, 'Invalid amount! Aborting transaction...'
+        state = self.snapshot.state
+        sender = account_id(sender_address)
+        if sender == account_id(recipient_address):
+            return None, "Cannot send coins to one's own wallet! Aborting transaction..."
 
-        self.lock_current_state.release()
-        return transaction.jsonfy()
+        with self.reservations.lock:
+            self.reservations.expire()
+            utxos = []
+            seen = set()
+            for tx in heapq.merge(
+                state.account_utxos_by_amount(sender_address),
+                self.mempool.pending_change(sender),
+                self.reservations.pending_change(sender, batch),
+                key=lambda tx: tx['amount'],
+                reverse=True):
+                if tx['id'] not in seen and not self.mempool.is_spent(sender, tx['id']) and \
+                    not self.reservations.is_reserved(sender, tx['id']):
+                    utxos.append(tx)
+                seen.add(tx['id'])
+            if not amount > 0 or sum(tx['amount'] for tx in utxos) < amount:
+                return None, 'Not enough coins! Aborting transaction...'
+
+            # Find utxos to spend. Dust is consolidated while the node is idle.
+            select_coins = self.select_coins if len(self.mempool) else self.select_coins_idle
+            spent_txs = select_coins(utxos, amount)
+
+            transaction = Transaction(
+                sender_address=sender_address,
+                recipient_address=account_id(recipient_address),
+                amount=amount,
+                spent_txs=spent_txs)
+            change = None
+            if len(transaction.output_txs) > 1:
+                change = utxo(transaction.output_txs[1], sender)
+            self.reservations.reserve(
+                transaction.id, sender, transaction.data['input_txs'], change)
+        self.tracer.stamp(transaction.id, 'created')
+        return transaction, None
+
+    # Set the current state to the state of the tail and publish a new snapshot
+    # for the queries. It is called with lock_current_state acquired.
+    def publish(self):
+        self.current_state = self.blockchain.tail_state()
+        tail_block = self.blockchain.chain.get(self.blockchain.tail_hash)
+        self.snapshot = Snapshot(tail_block, self.blockchain.length, self.current_state)
 
 
     # Enqueued transaction will be validated right before they are to be inserted
     # into a block. Before then, the state might change as new transactions are
-    # being processed.
+    # being processed. The signature is verified before the transaction is
+    # enqueued (the verification is cached for later), so that a forged copy
+    # cannot claim the inputs of a genuine transaction. Duplicates and double
+    # spends of pending transactions are rejected right away. Transactions from clients are relayed to the other
+    # nodes in batches, in the background, so that the client does not wait for
+    # every peer. The inputs reserved by the candidate are released, since the
+    # mempool indexes them from now on.
     def commit_transaction(self, transaction, is_local):
-        self.transactions_queue.put(transaction)
+        if not transaction.check():
+            result = 'Invalid transaction'
+        else:
+            result = self.mempool.add(transaction)
+            self.release_candidate(transaction, result)
+        self.trace_commit(transaction, result, is_local)
         # Broadcast if the transaction comes from a client instead of another node.
-        if is_local:
-            payload = json.dumps({
-                "transaction_json": transaction.jsonfy(),
-                "is_local": False
-            })
-            self.broadcaster.broadcast_post(payload, '/transaction')
-        return "Transaction Enqueued"
+        if is_local and result == 'Transaction Enqueued':
+            self.batcher.add(transaction)
+        return result
 
+    # A batch of transactions (relayed by another node or sent by a client) is
+    # enqueued in one go. Returns the result of every transaction.
+    def commit_transactions(self, transactions, is_local=False):
+        checks = [transaction.check() for transaction in transactions]
+        added = iter(self.mempool.add_many(
+            [transaction for transaction, valid in zip(transactions, checks) if valid]))
+        results = []
+        for transaction, valid in zip(transactions, checks):
+            if not valid:
+                result = 'Invalid transaction'
+            else:
+                result = next(added)
+                self.release_candidate(transaction, result)
+            results.append(result)
+            self.trace_commit(transaction, result, is_local)
+            if is_local and result == 'Transaction Enqueued':
+                self.batcher.add(transaction)
+        return results
+
+    # The reservation of an enqueued transaction is no longer needed (the
+    # mempool indexes its inputs and its change). A candidate that did not
+    # make it into the mempool is dropped, with the candidates that spend its
+    # change.
+    def release_candidate(self, transaction, result):
+        committed = result in ('Transaction Enqueued', 'Duplicate transaction')
+        self.reservations.release(transaction.id, committed)
+
+    def trace_commit(self, transaction, result, is_local):
+        if result != 'Transaction Enqueued':
+            self.tracer.stamp(transaction.id, 'rejected', result)
+        else:
+            self.tracer.stamp(transaction.id, 'committed' if is_local else 'received')
+
+    # Keep the mempool in line with a change of the main chain: the
+    # transactions of the blocks that joined it are evicted and those of the
+    # blocks that left it are pending again.
+    def update_mempool(self, old_tail_hash):
+        left, joined = self.blockchain.main_chain_changes(old_tail_hash)
+        included = []
+        for block in joined:
+            included += self.blockchain.block_transactions(block)
+        self.mempool.remove_included(included)
+        included_ids = set(transaction.id for transaction in included)
+        for block in reversed(left):
+            self.mempool.reinject([transaction
+                for transaction in self.blockchain.block_transactions(block)
+                if transaction.id not in included_ids])
+
+
+    def trace_transactions(self, transactions, stage, detail=None):
+        if self.tracer.enabled:
+            self.tracer.stamp_many([transaction.id for transaction in transactions], stage, detail)
+
+    def broadcast_block(self, block, wait=True):
+        payload = json.dumps(block_dict(block))
+        binary_payload = None
+        if self.wire_format == 'binary':
+            binary_payload = wire.encode_block(block)
+        self.broadcaster.broadcast_post(payload, endpoint='/block', wait=wait,
+            binary_payload=binary_payload)
+
+    # Rebuild the sealed blocks and the mining state on top of the current
+    # state, keeping the transactions acquired thus far that are still valid.
+    # It is called with lock_current_state acquired.
+    def rebase_mining(self):
+        transactions = [transaction for sealed in self.sealed for transaction in sealed]
+        transactions += self.mining_transactions
+        self.sealed.clear()
+        self.mining_state = State(initial_state=self.current_state)
+        self.mining_transactions = []
+        self.mining_size = 0
+        self.mining_deadline = None
+        self.mining_base = self.blockchain.tail_hash
+        for transaction in transactions:
+            self.assemble(transaction)
+        self.mining_ready.notify_all()
+
+    # Place the transaction in the block being assembled. A transaction that
+    # does not fit goes in the next block; a full block is sealed.
+    def assemble(self, transaction):
+        if self.mining_transactions and \
+            self.mining_size + len(transaction.jsonfy()) > self.max_block_size:
+            self.seal_block()
+        self.place_transaction(transaction)
+        if len(self.mining_transactions) >= self.capacity or \
+            self.mining_size >= self.max_block_size:
+            self.seal_block()
+
+    # Validate the transaction against the mining state and place it in the
+    # next block (invalid transactions are discarded). The block must be mined
+    # at most block_max_latency seconds after its first transaction arrived.
+    def place_transaction(self, transaction):
+        if not self.mining_state.validate(transaction):
+            self.mempool.discard(transaction)
+            return
+        self.mining_state.update(transaction)
+        self.mining_transactions.append(transaction)
+        self.tracer.stamp(transaction.id, 'placed')
+        self.mining_size += len(transaction.jsonfy())
+        deadline = self.mempool.arrival(transaction.id) + self.block_max_latency
+        if self.mining_deadline is None or deadline < self.mining_deadline:
+            self.mining_deadline = deadline
+
+    # Hand the assembled block over to the mining thread. The next block is
+    # assembled on top of its state, so its transactions are not validated
+    # again when the sealed block is added.
+    def seal_block(self):
+        self.sealed.append(self.mining_transactions)
+        self.trace_transactions(self.mining_transactions, 'sealed')
+        self.mining_state = State(initial_state=self.mining_state)
+        self.mining_transactions = []
+        self.mining_size = 0
+        self.mining_deadline = None
+        self.mining_ready.notify_all()
 
     # This method runs on a separate thread.
-    # It periodically checks the transactions queue. If a valid transaction is
-    # found in the queue it is placed in the next block.
-    # When the block is filled or enough time elapses without new transactions
-    # the block is mined and broadcasted.
+    # It checks the mempool. If a valid transaction is found in the mempool
+    # it is placed in the block being assembled (invalid ones are discarded).
+    # The block is sealed and handed over to the mining thread when it is full
+    # (CAPACITY transactions or MAX_BLOCK_SIZE bytes) or when BLOCK_MAX_LATENCY
+    # seconds have passed since its first transaction arrived. The next block
+    # is assembled while the sealed ones are mined; no more transactions are
+    # taken while MINING_PIPELINE blocks are waiting to be mined.
+    # Whenever the tail of the blockchain changes (foreign block or switch to
+    # another branch) the sealed blocks and the mining state are rebased onto
+    # the new tail.
     def process(self):
-        #  Create and mine a block with the transactions acquired thus far.
-        def mine():
-            # print('mining')
-            broadcast = False
-            current_block = self.blockchain.create_block(self.mining_transactions)
-            self.blockchain.mine_block(current_block)
-            # The mining could be interrupted.
-            self.lock_current_state.acquire()
-            if (self.blockchain.mining_flag):
-                self.blockchain.add_block(current_block)
-                self.current_state = self.blockchain.tail_state()
-                broadcast = True
+        Thread(target=self.mine_sealed, daemon=True).start()
 
-            self.mining_state = State(initial_state=self.current_state)
-            self.mining_transactions = []
-
-            self.lock_current_state.release()
-            if broadcast:
-                payload = json.dumps(current_block)
-                self.broadcaster.broadcast_post(payload, endpoint='/block')
+        def rebase_if_needed():
+            if self.mining_base != self.blockchain.tail_hash:
+                self.rebase_mining()
 
         while True:
             # print('..')
-            try:
-                transaction = self.transactions_queue.get(block=True, timeout=4)
-                if self.mining_state.validate(transaction):
-                    self.mining_state.update(transaction)
-                    self.mining_transactions.append(transaction)
-                    if len(self.mining_transactions) == self.capacity:
-                        # print('full')
-                        mine()  # block full
-            except Empty:
-                if len(self.mining_transactions) > 0:
+            with self.mining_ready:
+                rebase_if_needed()
+                if self.mining_transactions and time.monotonic() >= self.mining_deadline:
                     # print('time')
-                    mine()  # time out
-
-    # If a node receives a valid foreign block that fits at the end of the chain,
-    # then the node stops mining and appends the foreign block onto the 
-    # blockchain. The state is updated accordingly.
-    # If the (valid) foreign block does not fit at the end, then it is still
-    # added onto the blockchain incase the branch it begins grows to become
-    # the longes.
+                    self.seal_block()
+                while len(self.sealed) >= self.mining_pipeline:
+                    self.mining_ready.wait()
+                    rebase_if_needed()
+                timeout = None   # nothing to mine, wait for transactions
+                if self.mining_deadline is not None:
+                    timeout = max(0, self.mining_deadline - time.monotonic())
+            transaction = self.mempool.get(timeout=timeout)
+            if transaction:
+                with self.mining_ready:
+                    rebase_if_needed()
+                    self.assemble(transaction)
+
+    # This method runs on a separate thread.
+    # It mines the sealed blocks in order and broadcasts them. A block is added
+    # only if it still extends the tail; otherwise the mining is interrupted
+    # (even if the tail moved before the mining started) and the block is
+    # rebuilt by the processing thread.
+    def mine_sealed(self):
+        while True:
+            with self.mining_ready:
+                while not self.sealed or self.mining_base != self.blockchain.tail_hash:
+                    self.mining_ready.wait()
+                transactions = self.sealed[0]
+                current_block = self.blockchain.create_block(transactions)
+            # print('mining')
+            nonce = self.blockchain.mine_block(current_block,
+                lambda: current_block['previous_hash'] == self.blockchain.tail_hash)
+            mined = False
+            with self.mining_ready:
+                if nonce is not None and self.blockchain.mining_flag and \
+                    current_block['previous_hash'] == self.blockchain.tail_hash:
+                    self.blockchain.add_block(current_block)
+                    self.publish()
+                    self.mempool.remove_included(transactions)
+                    self.sealed.popleft()
+                    self.mining_base = self.blockchain.tail_hash
+                    self.mining_ready.notify_all()
+                    mined = True
+                    self.trace_transactions(transactions, 'mined', current_block['index'])
+                elif nonce is not None:
+                    stale_blocks.inc()
+            if mined:
+                self.broadcast_block(current_block, wait=False)
+
+    # If a node receives a valid foreign block whose parent is known, the block
+    # is added onto the blockchain. If its branch becomes the heaviest, the node
+    # stops mining and switches its state to the new tail. The states of the
+    # blocks of the new branch were computed from their parents when they were
+    # added, so only the diverging blocks are applied.
+    # A block whose parent is unknown is kept until its ancestors are fetched
+    # from the peers.
     def get_block(self, foreign_block):
+        is_genesis = self.snapshot.length == 0 and foreign_block['index'] == 0
+        if not is_genesis and foreign_block['previous_hash'] not in self.blockchain.chain:
+            if not self.blockchain.validate_block_proof(foreign_block):
+                return 'Invalid Block!'
+            self.sync.add_orphan(foreign_block)
+            return 'Block queued until its ancestors arrive'
+        return self.add_foreign_block(foreign_block)
+
+    def add_foreign_block(self, foreign_block):
         # When the current state is empty the node expects the genesis block.
         # The genesis block is not validated.
-        if self.current_state.empty():
+        if self.snapshot.length == 0 and foreign_block['index'] == 0:
             self.lock_current_state.acquire()
             self.blockchain.add_block(foreign_block)
-            self.current_state = self.blockchain.tail_state()
-            self.mining_state = State(initial_state=self.current_state)
+            self.publish()
             self.lock_current_state.release()
             return 'Genesis block added'
         
-        # The foreign (incoming) block is validated. Then there is a check for
-        # conflicts, i.e., the block goes at the end of the chain and contains
-        # transactions that are different than those in the block being mined locally.
         self.lock_current_state.acquire()
-        if not self.blockchain.validate_block(foreign_block):  # changes the tail state of the block
+        if foreign_block['current_hash'] in self.blockchain.chain:
+            self.lock_current_state.release()
+            return 'Block already known'
+        if not self.blockchain.validate_block(foreign_block):
             print('invalid block')
             self.lock_current_state.release()
             return 'Invalid Block!'
-        self.blockchain.stop_mining()
-        # print('handling valid block')
+        tail_hash = self.blockchain.tail_hash
         self.blockchain.add_block(foreign_block)
-        if self.blockchain.length - 1 == foreign_block['index']:
-            self.current_state = self.blockchain.tail_state()
+        self.trace_transactions(foreign_block['transactions'], 'added', foreign_block['index'])
+        if self.blockchain.tail_hash != tail_hash:
+            self.blockchain.stop_mining()
+            self.publish()
+            self.update_mempool(tail_hash)
+            # Wake up the processing thread to rebase the blocks being mined.
+            self.mining_ready.notify_all()
+            self.mempool.interrupt()
         self.lock_current_state.release()
         return 'Block added'
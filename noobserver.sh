@@ -6,7 +6,27 @@ export BOOTSTRAP_IP=127.0.0.1
 export BOOTSTRAP_PORT=5000
 export NODE_PORT=$1
 export CAPACITY=3
+export MAX_BLOCK_SIZE=1000000
+export BLOCK_MAX_LATENCY=4
+export MINING_PIPELINE=2
+export COIN_SELECTION=branch_and_bound
+export IDLE_COIN_SELECTION=consolidate
+export RESERVATION_TTL=60
+export STATE_RETENTION=100
+export CHECKPOINT_INTERVAL=100
 export TOTAL_COINS=1000
+export MINING_WORKERS=1
+export VERIFY_WORKERS=1
+export BROADCAST_TIMEOUT=5
+export BATCH_SIZE=100
+export BATCH_DELAY=5
+export SYNC_BATCH_SIZE=50
+export WIRE_FORMAT=json   # json or binary
+export MEMPOOL_SIZE=100000
+export TRACING=0          # 1 to stamp every transaction at each stage (see /trace/<id>)
+export TRACE_SIZE=10000
+# export TRACE_FILE=./trace-${1:-5000}.jsonl   # uncomment to append the stamps to a file
+# export DATA_DIR=./noobdata/${1:-5000}   # uncomment to store the chain on disk
 
 if [ $1 ]
 then 
@@ -0,0 +1,88 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+class Reservations:
+    """
+    The utxos spent by the candidate transactions that were sent to clients
+    for signing and have not come back yet. A new candidate does not spend a
+    reserved utxo, so a sender can request many candidates in a row without
+    them being rejected as double spends after they are signed. The change of
+    a candidate may be spent by the next candidates of the same batch, which
+    are then valid once they are committed after it. A reservation is released
+    when the signed transaction is committed (the mempool then indexes its
+    inputs and its change). If it expires after ttl seconds or the candidate
+    is dropped, the candidates that spend its change are dropped as well,
+    since their inputs will never exist.
+    """
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.candidates = OrderedDict()   # candidate id -> (expiry, sender account id, utxo ids), by expiry
+        self.reserved = {}                # sender account id -> {utxo id: candidate id}
+        self.change = {}                  # sender account id -> {candidate id: change utxo}
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.candidates)
+
+    # Whether the utxo is reserved. It is called with the lock acquired.
+    def is_reserved(self, sender_id, utxo_id):
+        return utxo_id in self.reserved.get(sender_id, ())
+
+    # The change utxos of the given candidates of the sender, largest amount
+    # first. It is called with the lock acquired.
+    def pending_change(self, sender_id, candidate_ids):
+        sender_change = self.change.get(sender_id, {})
+        return sorted((sender_change[id] for id in candidate_ids if id in sender_change),
+            key=lambda tx: tx['amount'], reverse=True)
+
+    # Reserve the utxos spent by a candidate and keep its change utxo (if
+    # any). It is called with the lock acquired.
+    def reserve(self, candidate_id, sender_id, utxo_ids, change=None):
+        self.expire()
+        self.remove(candidate_id)
+        self.candidates[candidate_id] = (time.monotonic() + self.ttl, sender_id, utxo_ids)
+        sender_reserved = self.reserved.setdefault(sender_id, {})
+        for utxo_id in utxo_ids:
+            sender_reserved[utxo_id] = candidate_id
+        if change:
+            self.change.setdefault(sender_id, {})[candidate_id] = change
+
+    # Release the reservation of a committed candidate, or drop the candidate
+    # (and its dependents) if it was not committed.
+    def release(self, candidate_id, committed=True):
+        with self.lock:
+            self.remove(candidate_id, dependents=not committed)
+
+    def expire(self):
+        now = time.monotonic()
+        while self.candidates:
+            candidate_id, (expiry, _, _) = next(iter(self.candidates.items()))
+            if expiry > now:
+                return
+            self.remove(candidate_id, dependents=True)
+
+    # Remove a reservation. With dependents, the chain of candidates that
+    # spend the change of the removed ones is removed too.
+    def remove(self, candidate_id, dependents=False):
+        while candidate_id:
+            candidate = self.candidates.pop(candidate_id, None)
+            if not candidate:
+                return
+            _, sender_id, utxo_ids = candidate
+            sender_reserved = self.reserved[sender_id]
+            for utxo_id in utxo_ids:
+                if sender_reserved.get(utxo_id) == candidate_id:
+                    del sender_reserved[utxo_id]
+            if not sender_reserved:
+                del self.reserved[sender_id]
+            change = None
+            sender_change = self.change.get(sender_id)
+            if sender_change is not None:
+                change = sender_change.pop(candidate_id, None)
+                if not sender_change:
+                    del self.change[sender_id]
+            # The candidate (at most one) that spends the change.
+            candidate_id = None
+            if dependents and change:
+                candidate_id = self.reserved.get(sender_id, {}).get(change['id'])
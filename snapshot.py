@@ -0,0 +1,14 @@
+from state import State
+
+class Snapshot:
+    """
+    A consistent view of the main chain: its tail block, its length and the
+    state after its tail. A snapshot is never modified. The threads that move
+    the tail publish a new snapshot by replacing the reference held by the
+    node, so a query takes the reference once and reads without any lock,
+    while blocks keep arriving, and never sees a half-updated state.
+    """
+    def __init__(self, tail_block=None, length=0, state=None):
+        self.tail_block = tail_block
+        self.length = length
+        self.state = state if state is not None else State()
@@ -1,68 +1,176 @@
-from transaction import Transaction
-import copy
+from verifier import verifier
+from accounts import account_id
+from metrics import registry
+
+consume_time = registry.histogram(
+    'noobcash_consume_block_seconds', 'Time to apply the transactions of a block to a state')
+
+# A state that would be stacked on more than this many layers is flattened
+# when it is created, so that lookups never walk a long chain of parents.
+MAX_LAYERS = 32
+
+# The utxo record of an output tx. It refers to the recipient by account id.
+def utxo(out_tx, recipient):
+    return {
+        'id': out_tx['id'],
+        'recipient': recipient,
+        'amount': out_tx['amount']
+    }
 
 class State:
     """
     The state object stores and updates the utxos (and balances) of all nodes.
+
+    States are layered (copy-on-write). A state created from an initial state
+    stores only the accounts that changed since then and looks up everything
+    else in its parent, so consuming a block costs time and memory proportional
+    to the accounts touched by its transactions. A state must not be updated
+    once other states have been created from it.
+
+    Accounts are identified by their ids (see accounts). The methods accept
+    either the public key or the id of an account.
     """
     def __init__(self, initial_state=None):
-        if initial_state:
-            # dict within dict => deepcopy!
-            self.utxos = copy.deepcopy(initial_state.utxos)
-            self.balances = copy.deepcopy(initial_state.balances)
-        else:
-            self.utxos = {}
-            """
-            The variable utxos is a dict with keys the public_keys identifying each
-            node. The values are dicts themselves with keys the tx ids and values the
-            tx data (id, recipient, amount).
-            e.g.
-            {
-                'pk1': {
-                    '34east34': {
-                        'id': '34east34',
-                        'recipient':'pk1',
-                        'amount':100
-                    }
+        self.parent = initial_state
+        self.layers = initial_state.layers + 1 if initial_state else 0
+
+        self.utxos = {}
+        """
+        The variable utxos is a dict with keys the account ids identifying each
+        node. The values are dicts themselves with keys the tx ids and values the
+        tx data (id, recipient account id, amount). Only the accounts changed in
+        this layer are present.
+        e.g.
+        {
+            'id1': {
+                '34east34': {
+                    'id': '34east34',
+                    'recipient':'id1',
+                    'amount':100
                 }
             }
-            """
-            
-            self.balances = {}
-            """
-            The variable balances stores the remaining coins (NBCs) for each
-            public key. Essentially, it stores the sum of the amounts of all
-            utxos for each public key.
-            e.g.
-            { 'pk1': 100 }
-            """
+        }
+        """
+
+        self.balances = {}
+        """
+        The variable balances stores the remaining coins (NBCs) for each
+        account id. Essentially, it stores the sum of the amounts of all
+        utxos for each account. Only the accounts changed in this layer
+        are present.
+        e.g.
+        { 'id1': 100 }
+        """
+
+        # Account ids whose utxo dicts were copied into this layer and can be
+        # modified in place. The rest may be shared with the parent states.
+        self.owned = set()
+
+        # The utxos of the accounts whose utxo dicts are held by this layer,
+        # sorted by amount (see account_utxos_by_amount).
+        self.sorted_utxos = {}
+
+        if self.layers > MAX_LAYERS:
+            self.flatten()
+
+    # Merge all parent layers into this one. The utxo dicts of the accounts
+    # are shared with the parents (not copied).
+    def flatten(self):
+        layers = []
+        state = self
+        while state:
+            layers.append(state)
+            state = state.parent
+        utxos = {}
+        balances = {}
+        for state in reversed(layers):
+            utxos.update(state.utxos)
+            balances.update(state.balances)
+        self.utxos = utxos
+        self.balances = balances
+        self.parent = None
+        self.layers = 0
+
+    # The utxos of an account. The returned dict must not be modified.
+    def account_utxos(self, public_key):
+        id = account_id(public_key)
+        state = self
+        while state:
+            if id in state.utxos:
+                return state.utxos[id]
+            state = state.parent
+        return {}
+
+    # The utxos of an account, largest amount first. The sorted list is kept
+    # by the layer that holds the utxo dict of the account, so it is computed
+    # again only after the account changes. The returned list must not be
+    # modified.
+    def account_utxos_by_amount(self, public_key):
+        id = account_id(public_key)
+        state = self
+        while state:
+            if id in state.utxos:
+                sorted_utxos = state.sorted_utxos.get(id)
+                if sorted_utxos is None:
+                    sorted_utxos = sorted(state.utxos[id].values(),
+                        key=lambda tx: tx['amount'], reverse=True)
+                    state.sorted_utxos[id] = sorted_utxos
+                return sorted_utxos
+            state = state.parent
+        return []
+
+    # Copy the utxos of an account into this layer before modifying them.
+    def writable_utxos(self, public_key):
+        id = account_id(public_key)
+        self.sorted_utxos.pop(id, None)
+        if id not in self.owned:
+            self.utxos[id] = dict(self.account_utxos(id))
+            self.owned.add(id)
+        return self.utxos[id]
+
     def empty(self):
-        return len(self.utxos) == 0 or len(self.balances) == 0
+        state = self
+        while state:
+            if state.balances:
+                return False
+            state = state.parent
+        return True
 
     def check_balance(self, public_key, amount):
-        return (public_key in self.balances) and (self.balances[public_key] >= amount) and (amount > 0)
+        return self.get_balance(public_key) >= amount and (amount > 0)
     
     def get_balance(self, public_key):
-        if public_key not in self.balances:
-            return 0
-        return self.balances[public_key]
+        id = account_id(public_key)
+        state = self
+        while state:
+            if id in state.balances:
+                return state.balances[id]
+            state = state.parent
+        return 0
     
     def equals(self, other_state):
-        return self.utxos == other_state.utxos and self.balances == other_state.balances
+        this = State(initial_state=self)
+        other = State(initial_state=other_state)
+        this.flatten()
+        other.flatten()
+        return this.utxos == other.utxos and this.balances == other.balances
 
     # Validate the transaction given the utxos. Also check the integrity and
-    # the signature of the transaction.
-    def validate(self, transaction):
+    # the signature (unless it was already verified) of the transaction.
+    def validate(self, transaction, check_signature=True):
 		# validate balance
         sender_address = transaction.data['sender_address']
         amount = transaction.data['amount']
         input_txs = transaction.data['input_txs']
         if not self.check_balance(sender_address, amount):
             return False
+        sender_utxos = self.account_utxos(sender_address)
         for itx in input_txs:
-            if itx not in self.utxos[sender_address].keys():
+            if itx not in sender_utxos:
                 return False
         # validate signature
+        if not check_signature:
+            return transaction.check_integrity()
         return transaction.check()
 
 
@@ -70,55 +178,60 @@ class State:
     # Run validate first or in the case of invalid transaction an exception
     # will be thrown.
     def update(self, transaction):
-        sender_address = transaction.data['sender_address']
-        receiver_address = transaction.data['receiver_address']
+        sender = account_id(transaction.data['sender_address'])
+        receiver = account_id(transaction.data['receiver_address'])
         amount = transaction.data['amount']
-        self.balances[sender_address] -= amount
-        if receiver_address not in self.balances:
-            self.balances[receiver_address] = amount
-        else:
-            self.balances[receiver_address] += amount
+        self.balances[sender] = self.get_balance(sender) - amount
+        self.balances[receiver] = self.get_balance(receiver) + amount
 
         # Remove input txs from sender's utxos
+        sender_utxos = self.writable_utxos(sender)
         input_txs = transaction.data['input_txs']
         for itx in input_txs:
-            del self.utxos[sender_address][itx]
+            del sender_utxos[itx]
         
         # Add output tx to recipient's utxos (and to sender's utxos if there are change)
         out_tx = transaction.output_txs[0]
-        if receiver_address not in self.utxos:
-            self.utxos[receiver_address] = {}
-        self.utxos[receiver_address][out_tx['id']] = out_tx
+        self.writable_utxos(receiver)[out_tx['id']] = utxo(out_tx, receiver)
 
         if len(transaction.output_txs) > 1:
             change_tx = transaction.output_txs[1]
-            self.utxos[sender_address][change_tx['id']] = change_tx
+            sender_utxos[change_tx['id']] = utxo(change_tx, sender)
 
 
     # Use this method to update the state with a transaction that creates new
     # NBCs, i.e., coins with no previous owner).
     def inflate(self, transaction):
-        receiver_address = transaction.data['receiver_address']
+        receiver = account_id(transaction.data['receiver_address'])
         amount = transaction.data['amount']
-        if receiver_address not in self.balances:
-            self.balances[receiver_address] = amount
-        else:
-            self.balances[receiver_address] += amount
+        self.balances[receiver] = self.get_balance(receiver) + amount
         
         out_tx = transaction.output_txs[0]
-        if receiver_address not in self.utxos:
-            self.utxos[receiver_address] = {}
-        self.utxos[receiver_address][out_tx['id']] = out_tx
+        self.writable_utxos(receiver)[out_tx['id']] = utxo(out_tx, receiver)
     
+    # The ids and then the signatures of the transactions are verified up
+    # front (in parallel if the verifier has a pool), so that no signature of
+    # a transaction whose id is not the hash of its data is ever cached. The
+    # utxo checks depend on the order of the transactions and run sequentially.
     def consume_block(self, block):
+        with consume_time.time():
+            return self.consume(block)
+
+    def consume(self, block):
         next_state = State(initial_state=self)
-        for transaction_json in block['transactions']:
-            transaction = Transaction(transaction_json=transaction_json)
+        transactions = block['transactions']
+        if not self.empty():
+            if not all(t.check_integrity() for t in transactions):
+                return None
+            signatures = [(t.data['sender_address'], t.id, t.signature) for t in transactions]
+            if not all(signature for _, _, signature in signatures) or \
+                not verifier.verify_all(signatures):
+                return None
+        for transaction in transactions:
             if next_state.empty():
                 next_state.inflate(transaction)
-            elif next_state.validate(transaction):
+            elif next_state.validate(transaction, check_signature=False):
                 next_state.update(transaction)
             else:
                 return None
         return next_state
-
@@ -0,0 +1,100 @@
+import json
+import mmap
+import os
+import struct
+from state import State
+from blockchain import block_dict, parse_block
+
+class BlockStore:
+    """
+    Stores the blockchain on disk so that a node can restart without
+    replaying every block.
+
+    blocks.log      append-only log with one JSON block per line
+    blocks.idx      one fixed-size (offset, length) record per block of the log
+    state.snapshot  the (flattened) state after some block of the main chain
+    """
+    RECORD = struct.Struct('>QI')
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.log_path = os.path.join(directory, 'blocks.log')
+        self.index_path = os.path.join(directory, 'blocks.idx')
+        self.snapshot_path = os.path.join(directory, 'state.snapshot')
+        self.repair()
+        self.log = open(self.log_path, 'ab')
+        self.index = open(self.index_path, 'ab')
+        self.log_size = os.path.getsize(self.log_path)
+
+    # A crash could leave a partially written record at the end of the files.
+    # Drop the records of the index that do not point to complete blocks.
+    def repair(self):
+        for path in [self.log_path, self.index_path]:
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+        log_size = os.path.getsize(self.log_path)
+        records = self.records()
+        while records and sum(records[-1]) + 1 > log_size:
+            records.pop()
+        valid_size = records[-1][0] + records[-1][1] + 1 if records else 0
+        with open(self.index_path, 'r+b') as index:
+            index.truncate(len(records) * self.RECORD.size)
+        with open(self.log_path, 'r+b') as log:
+            log.truncate(valid_size)
+
+    def records(self):
+        with open(self.index_path, 'rb') as index:
+            data = index.read()
+        count = len(data) // self.RECORD.size
+        return [self.RECORD.unpack_from(data, i * self.RECORD.size) for i in range(count)]
+
+    def append(self, block):
+        data = str.encode(json.dumps(block_dict(block), sort_keys=True))
+        self.log.write(data + b'\n')
+        self.log.flush()
+        self.index.write(self.RECORD.pack(self.log_size, len(data)))
+        self.index.flush()
+        self.log_size += len(data) + 1
+
+    # The blocks in the order in which they were appended.
+    def load_blocks(self):
+        if self.log_size == 0:
+            return []
+        blocks = []
+        with open(self.log_path, 'rb') as log:
+            with mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for offset, length in self.records():
+                    blocks.append(parse_block(json.loads(data[offset:offset + length])))
+        return blocks
+
+    # The snapshot is written to a temporary file first, so that a crash
+    # never leaves a half written snapshot behind.
+    def save_snapshot(self, hash, state):
+        flat_state = State(initial_state=state)
+        flat_state.flatten()
+        snapshot = {
+            'hash': hash,
+            'utxos': flat_state.utxos,
+            'balances': flat_state.balances
+        }
+        temporary_path = self.snapshot_path + '.tmp'
+        with open(temporary_path, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, self.snapshot_path)
+
+    # Returns (hash, state) or None if there is no snapshot.
+    def load_snapshot(self):
+        if not os.path.exists(self.snapshot_path):
+            return None
+        with open(self.snapshot_path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+        state = State()
+        state.utxos = snapshot['utxos']
+        state.balances = snapshot['balances']
+        return snapshot['hash'], state
+
+    def close(self):
+        self.log.close()
+        self.index.close()
@@ -0,0 +1,142 @@
+from queue import Queue
+from threading import Lock, Thread
+from requests.exceptions import RequestException
+from blockchain import parse_block
+from verifier import verifier
+
+class ChainSync:
+    """
+    Fetches the blocks that a node is missing from its peers.
+
+    A foreign block whose parent is unknown is kept as an orphan and a sync
+    starts on a separate thread: a peer whose main chain leads to the orphan
+    is found, the point where its chain forks from ours is located and the
+    blocks after it are downloaded by height in batches. The download runs in
+    a pipeline: while a batch is added to the blockchain, the next one is
+    being fetched and its signatures verified. Blocks are added through
+    Node.add_foreign_block, which switches to the heaviest branch.
+    """
+    def __init__(self, node, batch_size=50, max_orphans=1000):
+        self.node = node
+        self.batch_size = batch_size
+        self.max_orphans = max_orphans
+        self.orphans = {}   # hash -> block whose parent is unknown
+        self.lock = Lock()
+        self.running = False
+
+    def add_orphan(self, block):
+        with self.lock:
+            if len(self.orphans) >= self.max_orphans:
+                del self.orphans[next(iter(self.orphans))]   # the oldest
+            self.orphans[block['current_hash']] = block
+            if self.running:
+                return
+            self.running = True
+        Thread(target=self.run, daemon=True).start()
+
+    # This method runs on a separate thread until no orphans are left.
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.orphans:
+                    self.running = False
+                    return
+                target = max(self.orphans.values(), key=lambda block: block['index'])
+            self.sync_to(target)
+            self.connect_orphans()
+            with self.lock:
+                # If the sync failed, the orphan is given up.
+                self.orphans.pop(target['current_hash'], None)
+
+    # Add the orphans whose parents are now known.
+    def connect_orphans(self):
+        while True:
+            with self.lock:
+                connected = [block for block in self.orphans.values()
+                    if block['previous_hash'] in self.node.blockchain.chain]
+                for block in connected:
+                    del self.orphans[block['current_hash']]
+            if not connected:
+                return
+            for block in sorted(connected, key=lambda block: block['index']):
+                self.node.add_foreign_block(block)
+
+    def sync_to(self, target):
+        peer = self.find_peer(target)
+        if not peer:
+            return
+        fork = self.find_fork(peer, target['index'] - 1)
+        self.download(peer, fork + 1, target['index'])
+
+    # A peer whose main chain contains the parent of the target block.
+    def find_peer(self, target):
+        for ip, port in self.node.broadcaster.targets:
+            blocks = self.fetch((ip, port), target['index'] - 1, target['index'])
+            if blocks and blocks[0]['current_hash'] == target['previous_hash']:
+                return (ip, port)
+        return None
+
+    # The height of the last block of the peer's main chain (up to the given
+    # height) that is also in our blockchain, or -1 if there is none.
+    def find_fork(self, peer, height):
+        end = min(height, self.node.blockchain.length - 1) + 1
+        while end > 0:
+            start = max(0, end - self.batch_size)
+            blocks = self.fetch(peer, start, end)
+            if not blocks:
+                return -1
+            for block in reversed(blocks):
+                if block['current_hash'] in self.node.blockchain.chain:
+                    return block['index']
+            end = start
+        return -1
+
+    # Download and add the peer's blocks with start <= index < end.
+    def download(self, peer, start, end):
+        batches = Queue(maxsize=2)
+
+        def fetch_batches():
+            for batch_start in range(start, end, self.batch_size):
+                blocks = self.fetch(peer, batch_start, min(batch_start + self.batch_size, end))
+                self.verify_signatures(blocks)
+                batches.put(blocks)
+                if not blocks:
+                    break
+            batches.put(None)
+
+        Thread(target=fetch_batches, daemon=True).start()
+        failed = False
+        while True:
+            blocks = batches.get()
+            if blocks is None:
+                return
+            for block in blocks:
+                if failed:
+                    break   # keep draining the queue so that the fetching thread finishes
+                if self.node.add_foreign_block(block) == 'Invalid Block!':
+                    failed = True
+
+    def fetch(self, peer, start, end):
+        ip, port = peer
+        endpoint = '/blocks?start=' + str(start) + '&end=' + str(end)
+        try:
+            r = self.node.broadcaster.send_get(ip, port, endpoint)
+            return [parse_block(block) for block in r.json()] if r.status_code == 200 else []
+        except (RequestException, ValueError, KeyError, TypeError):
+            return []
+
+    # Verify the signatures of a whole batch (in parallel if the verifier has
+    # a pool) before its blocks are validated one by one. The valid signatures
+    # are cached, so validation does not verify them again. Blocks without a
+    # valid proof and transactions whose id is not the hash of their data are
+    # left to the validation, which rejects them.
+    def verify_signatures(self, blocks):
+        signatures = []
+        for block in blocks:
+            if block['index'] == 0 or not self.node.blockchain.validate_block_proof(block):
+                continue
+            for transaction in block['transactions']:
+                if transaction.signature and transaction.check_integrity():
+                    signatures.append(
+                        (transaction.data['sender_address'], transaction.id, transaction.signature))
+        verifier.verify_all(signatures)
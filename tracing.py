@@ -0,0 +1,86 @@
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+
+# The stages of a transaction, in the order it normally goes through them.
+STAGES = [
+    'created',     # candidate created by this node (/candidate-transaction)
+    'committed',   # signed transaction of a client enqueued in the mempool
+    'received',    # transaction relayed by another node enqueued in the mempool
+    'rejected',    # not enqueued (invalid, duplicate, double spend, mempool full)
+    'relayed',     # sent to the other nodes in a batch
+    'placed',      # validated and placed in the block being assembled
+    'sealed',      # block handed over to the mining thread
+    'mined',       # block mined and added by this node
+    'added'        # block of another node added to the chain
+]
+
+
+class Tracer:
+    """
+    Stamps the ids of transactions with the time (wall clock, so that the
+    traces of different nodes can be merged) they reach each stage. The
+    stamps of the last max_transactions transactions are kept in memory and,
+    if a path is given, every stamp is also appended to that file as a JSON
+    line. A disabled tracer does nothing.
+    """
+    def __init__(self, enabled=False, path=None, max_transactions=10000):
+        self.enabled = enabled
+        self.max_transactions = max_transactions
+        self.node_id = None
+        self.events = OrderedDict()   # transaction id -> [(stage, time, detail)]
+        self.lock = Lock()
+        self.file = open(path, 'a') if enabled and path else None
+
+    def stamp(self, transaction_id, stage, detail=None):
+        if self.enabled:
+            self.stamp_many([transaction_id], stage, detail)
+
+    # Stamp many transactions (e.g., those of a block) with the same time.
+    def stamp_many(self, transaction_ids, stage, detail=None):
+        if not self.enabled:
+            return
+        now = time.time()
+        lines = []
+        with self.lock:
+            for transaction_id in transaction_ids:
+                events = self.events.get(transaction_id)
+                if events is None:
+                    events = self.events[transaction_id] = []
+                    if len(self.events) > self.max_transactions:
+                        self.events.popitem(last=False)
+                events.append((stage, now, detail))
+                if self.file:
+                    lines.append(json.dumps(self.record(transaction_id, stage, now, detail)) + '\n')
+            if lines:
+                self.file.write(''.join(lines))
+                self.file.flush()
+
+    def record(self, transaction_id, stage, stamp_time, detail):
+        record = {'node': self.node_id, 'id': transaction_id, 'stage': stage, 'time': stamp_time}
+        if detail is not None:
+            record['detail'] = detail
+        return record
+
+    # The stamps of a transaction on this node, in order.
+    def trace(self, transaction_id):
+        with self.lock:
+            events = list(self.events.get(transaction_id, []))
+        return [self.record(transaction_id, *event) for event in events]
+
+    # All the stamps kept in memory, as JSON lines (the format of the file).
+    def export(self):
+        with self.lock:
+            events = [(transaction_id, list(events)) for transaction_id, events in self.events.items()]
+        return ''.join(json.dumps(self.record(transaction_id, *event)) + '\n'
+            for transaction_id, events in events for event in events)
+
+
+# Merge the stamps of a transaction from many nodes in time order. Every stamp
+# gets the seconds elapsed since the first one.
+def merge(traces):
+    records = sorted((record for trace in traces for record in trace), key=lambda r: r['time'])
+    for record in records:
+        record['elapsed'] = round(record['time'] - records[0]['time'], 6)
+    return records
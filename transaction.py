@@ -1,15 +1,16 @@
 import json
+import sys
 from hashlib import sha256
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import hashes
-from cryptography.exceptions import InvalidSignature
-from cryptography.hazmat.primitives import serialization
+from verifier import verifier
+from accounts import account_id
 
 
 class Transaction:
     """
-    sender_address:     public key of sender/payer
-    recipient_address:  public key of recipient/payee
+    sender_address:     public key of sender/payer (needed to check the signature)
+    recipient_address:  account id (or public key) of recipient/payee
     amount:             number of NBCs sent
     spent_txs:          txs used by the sender for the transaction (transaction inputs)
 
@@ -17,20 +18,34 @@ class Transaction:
     of the form:
     {
         'id':           transaction_id,
-        'recipient':    recipient_public_key,
+        'recipient':    recipient_account_id,
         'amount':       transaction_amount
     }
+
+    A transaction is parsed once, when it arrives, and is not modified after
+    it is signed. It keeps its canonical JSON string, so it is sent, stored
+    and hashed in exactly that form, and the result of its integrity check.
     """
+    __slots__ = ('data', 'id', 'output_txs', 'signature', 'serialized', 'integrity')
+
     def __init__(
         self,
         sender_address=None,
         recipient_address=None,
         amount=None,
         spent_txs=None,
-        transaction_json=None):
+        transaction_json=None,
+        transaction_dict=None):
 
+        self.serialized = None
+        self.integrity = None
         if transaction_json:
-            self.copy(transaction_json)
+            # Only the canonical form is kept (and placed in blocks), so
+            # unknown fields of the received JSON are dropped.
+            self.copy(json.loads(transaction_json))
+            self.serialized = self.serialize()
+        elif transaction_dict:
+            self.copy(transaction_dict)
         else:
             self.build(sender_address, recipient_address, amount, spent_txs)
             
@@ -61,23 +76,25 @@ class Transaction:
 
         self.output_txs = [{
             'id': self.id,
-            'recipient': recipient_address,
+            'recipient': account_id(recipient_address),
             'amount': amount
         }]
         if input_value > amount:
             self.output_txs.append({
                 'id': self.id,
-                'recipient': sender_address,
+                'recipient': account_id(sender_address),
                 'amount': (input_value - amount)
             })
 
         # Transactions are not signed at creation
         self.signature = None
 
-    # Copy transaction from received json
-    def copy(self, transaction_json):
-        transaction_dict = json.loads(transaction_json)
+    # Copy transaction from received json (parsed into a dict). The public key
+    # of the sender is shared by all the transactions of the sender.
+    def copy(self, transaction_dict):
         self.data       = transaction_dict['data']
+        if isinstance(self.data.get('sender_address'), str):
+            self.data['sender_address'] = sys.intern(self.data['sender_address'])
         self.id         = transaction_dict['id']
         self.output_txs = transaction_dict['output_txs']
         self.signature  = transaction_dict['signature']
@@ -91,31 +108,33 @@ class Transaction:
                 mgf=padding.MGF1(hashes.SHA256()),
                 salt_length=padding.PSS.MAX_LENGTH),
             hashes.SHA256()).decode("ISO-8859-1")
+        self.serialized = None
+
+    # The id is the hash of the data (computed once).
+    def check_integrity(self):
+        if self.integrity is None:
+            transaction_dump = str.encode(json.dumps(self.data, sort_keys=True), "ISO-8859-1")
+            self.integrity = self.id == sha256(transaction_dump).hexdigest()
+        return self.integrity
 
     def check(self):
         # Check integrity
-        transaction_dump = str.encode(json.dumps(self.data, sort_keys=True), "ISO-8859-1")
-        if self.id != sha256(transaction_dump).hexdigest():
+        if not self.check_integrity():
             return False
-        # Authenticate signature
+        # Authenticate signature (cached by the verifier)
         if not self.signature:
             return False
-        try:
-            public_key = serialization.load_pem_public_key(
-                self.data['sender_address'].encode("ISO-8859-1"))
-            public_key.verify(
-                self.signature.encode("ISO-8859-1"),
-                self.id.encode("ISO-8859-1"),
-                padding.PSS(
-                    mgf=padding.MGF1(hashes.SHA256()),
-                    salt_length=padding.PSS.MAX_LENGTH),
-                hashes.SHA256())
-        except InvalidSignature:
-            return False
-        return True
+        return verifier.verify(self.data['sender_address'], self.id, self.signature)
 
 
+    # The JSON string of the transaction, i.e., its canonical serialization
+    # (computed once).
     def jsonfy(self):
+        if self.serialized is None:
+            self.serialized = self.serialize()
+        return self.serialized
+
+    def serialize(self):
         return json.dumps({
             "data":         self.data,
             "id":           self.id,
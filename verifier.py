@@ -0,0 +1,148 @@
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives import hashes
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import serialization
+
+
+# Batches with fewer signatures to verify than this are verified in-process,
+# since sending them to the pool would cost more than it saves.
+MIN_POOL_BATCH = 4
+
+
+class LRUCache:
+    """
+    A bounded dict that evicts the least recently used entry when full and
+    counts its hits and misses.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Returns None on a miss.
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+
+class SignatureVerifier:
+    """
+    Verifies the RSA-PSS signatures of transactions. Parsed public keys and
+    the (public key, transaction id, signature) triples that were verified
+    successfully are cached, so that a transaction checked when it enters the
+    mining state is not verified again when its block arrives. A cache hit
+    holds for the key that made the signature only; whether the id is the
+    hash of the data is up to the caller.
+    """
+    def __init__(self, key_cache_size=1024, signature_cache_size=65536):
+        self.public_keys = LRUCache(key_cache_size)
+        self.verified = LRUCache(signature_cache_size)
+        self.verifications = 0   # number of RSA verifications actually performed
+        self.lock = Lock()
+        self.workers = 1
+        self.pool = None
+
+    # With more than one worker, batches are verified by a process pool.
+    def set_workers(self, workers):
+        self.workers = workers
+
+    def clear(self):
+        with self.lock:
+            self.public_keys.entries.clear()
+            self.verified.entries.clear()
+
+    def public_key(self, public_key_pem):
+        with self.lock:
+            public_key = self.public_keys.get(public_key_pem)
+        if public_key is None:
+            public_key = serialization.load_pem_public_key(public_key_pem.encode("ISO-8859-1"))
+            with self.lock:
+                self.public_keys.put(public_key_pem, public_key)
+        return public_key
+
+    # The signature (latin-1 string) must be the signature of the transaction id
+    # by the private key that corresponds to public_key_pem.
+    def verify(self, public_key_pem, transaction_id, signature):
+        with self.lock:
+            if self.verified.get((public_key_pem, transaction_id, signature)):
+                return True
+        return self.verify_uncached(public_key_pem, transaction_id, signature)
+
+    # Verify without looking up the cache of verified signatures (the
+    # signature is cached if it is valid).
+    def verify_uncached(self, public_key_pem, transaction_id, signature):
+        try:
+            public_key = self.public_key(public_key_pem)
+        except ValueError:   # malformed public key
+            return False
+        with self.lock:
+            self.verifications += 1
+        try:
+            public_key.verify(
+                signature.encode("ISO-8859-1"),
+                transaction_id.encode("ISO-8859-1"),
+                padding.PSS(
+                    mgf=padding.MGF1(hashes.SHA256()),
+                    salt_length=padding.PSS.MAX_LENGTH),
+                hashes.SHA256())
+        except (InvalidSignature, ValueError):   # wrong or malformed signature
+            return False
+        with self.lock:
+            self.verified.put((public_key_pem, transaction_id, signature), True)
+        return True
+
+    # Verify many (public_key_pem, transaction_id, signature) triples. The
+    # signatures that are not cached are verified in parallel when a pool is
+    # configured. Returns True if all of them are valid.
+    def verify_all(self, signatures):
+        with self.lock:
+            pending = [s for s in signatures if not self.verified.get(tuple(s))]
+        if self.workers <= 1 or len(pending) < MIN_POOL_BATCH:
+            return all(self.verify_uncached(*s) for s in pending)
+        with self.lock:
+            if not self.pool:
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+        chunksize = max(1, len(pending) // (4 * self.workers))
+        results = list(self.pool.map(verify_in_worker, pending, chunksize=chunksize))
+        with self.lock:
+            self.verifications += len(pending)
+            for s, valid in zip(pending, results):
+                if valid:
+                    self.verified.put(tuple(s), True)
+        return all(results)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'key_cache_hits': self.public_keys.hits,
+                'key_cache_misses': self.public_keys.misses,
+                'signature_cache_hits': self.verified.hits,
+                'signature_cache_misses': self.verified.misses,
+                'verifications': self.verifications
+            }
+
+
+# Shared by all transactions of the node (each pool worker has its own).
+verifier = SignatureVerifier()
+
+
+# Runs in a pool worker process.
+def verify_in_worker(signature):
+    return verifier.verify(*signature)
@@ -0,0 +1,305 @@
+"""
+Compact binary encoding of transactions and blocks.
+
+All fields are length-prefixed. Hex digests are sent as raw bytes, public keys
+as DER bytes and signatures as raw bytes, instead of the JSON strings (nested
+in JSON strings) that are sent otherwise. Decoding gives back exactly the
+values that were encoded, so transaction ids and block hashes are unchanged.
+"""
+import base64
+import binascii
+import re
+import struct
+from transaction import Transaction
+from accounts import account_id
+
+MIME_TYPE = 'application/x-noobcash'
+
+# Field tags
+TEXT = 0    # utf-8 string
+HEX = 1     # 64 character lowercase hex string, sent as 32 bytes
+KEY = 2     # PEM public key, sent as DER bytes
+NONE = 3
+
+# Transaction tags
+STRUCTURED = 0
+RAW_JSON = 1    # for transaction strings that are not in the canonical form
+
+# Output recipients
+RECEIVER = 0
+SENDER = 1
+OTHER = 2
+SENDER_ACCOUNT = 3  # the account id of the sender (change)
+
+PEM_HEADER = '-----BEGIN PUBLIC KEY-----\n'
+PEM_FOOTER = '-----END PUBLIC KEY-----\n'
+HEX_PATTERN = re.compile('[0-9a-f]{64}')
+
+INT = struct.Struct('>q')
+LENGTH = struct.Struct('>I')
+SHORT_LENGTH = struct.Struct('>H')
+MAX_KEY_LENGTH = 0xFFFF
+
+
+def der_to_pem(der):
+    body = base64.b64encode(der).decode()
+    lines = [body[i:i + 64] + '\n' for i in range(0, len(body), 64)]
+    return PEM_HEADER + ''.join(lines) + PEM_FOOTER
+
+
+# The DER bytes of a PEM public key, or None if the key would not be
+# reproduced exactly by der_to_pem.
+def pem_to_der(pem):
+    if not pem.startswith(PEM_HEADER) or not pem.endswith(PEM_FOOTER):
+        return None
+    try:
+        der = base64.b64decode(pem[len(PEM_HEADER):-len(PEM_FOOTER)], validate=False)
+    except binascii.Error:
+        return None
+    return der if der_to_pem(der) == pem else None
+
+
+class Writer:
+    def __init__(self):
+        self.parts = []
+
+    def byte(self, value):
+        self.parts.append(bytes([value]))
+
+    # Only exact integers can be sent, so that decoding gives back the same value.
+    def int(self, value):
+        if type(value) is not int:
+            raise ValueError('Not an integer: ' + repr(value))
+        try:
+            self.parts.append(INT.pack(value))
+        except struct.error:
+            raise ValueError('Integer out of range: ' + repr(value))
+
+    def count(self, value):
+        self.parts.append(LENGTH.pack(value))
+
+    def bytes(self, value):
+        self.count(len(value))
+        self.parts.append(value)
+
+    def string(self, value):
+        if value is None:
+            self.byte(NONE)
+        elif HEX_PATTERN.fullmatch(value):
+            self.byte(HEX)
+            self.parts.append(bytes.fromhex(value))
+        else:
+            der = pem_to_der(value)
+            # Keys whose length does not fit in SHORT_LENGTH are sent as text.
+            if der is not None and len(der) <= MAX_KEY_LENGTH:
+                self.byte(KEY)
+                self.parts.append(SHORT_LENGTH.pack(len(der)))
+                self.parts.append(der)
+            else:
+                self.byte(TEXT)
+                self.bytes(value.encode())
+
+    def getvalue(self):
+        return b''.join(self.parts)
+
+
+class Reader:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.position = 0
+
+    def take(self, length):
+        if self.position + length > len(self.data):
+            raise ValueError('Truncated message')
+        value = self.data[self.position:self.position + length]
+        self.position += length
+        return value
+
+    def byte(self):
+        return self.take(1)[0]
+
+    def int(self):
+        return INT.unpack(self.take(INT.size))[0]
+
+    def count(self):
+        return LENGTH.unpack(self.take(LENGTH.size))[0]
+
+    def bytes(self):
+        return bytes(self.take(self.count()))
+
+    def string(self):
+        tag = self.byte()
+        if tag == NONE:
+            return None
+        if tag == HEX:
+            return self.take(32).hex()
+        if tag == KEY:
+            length = SHORT_LENGTH.unpack(self.take(SHORT_LENGTH.size))[0]
+            return der_to_pem(bytes(self.take(length)))
+        if tag == TEXT:
+            return self.bytes().decode()
+        raise ValueError('Unknown field tag ' + str(tag))
+
+
+def write_transaction(writer, transaction):
+    data = transaction.data
+    writer.string(data['sender_address'])
+    writer.string(data['receiver_address'])
+    writer.int(data['amount'])
+    writer.count(len(data['input_txs']))
+    for input_id in data['input_txs']:
+        writer.string(input_id)
+    writer.string(transaction.id)
+    writer.count(len(transaction.output_txs))
+    for tx in transaction.output_txs:
+        writer.string(tx['id'])
+        if tx['recipient'] == data['receiver_address']:
+            writer.byte(RECEIVER)
+        elif tx['recipient'] == data['sender_address']:
+            writer.byte(SENDER)
+        elif tx['recipient'] == account_id(data['sender_address']):
+            writer.byte(SENDER_ACCOUNT)
+        else:
+            writer.byte(OTHER)
+            writer.string(tx['recipient'])
+        writer.int(tx['amount'])
+    if transaction.signature is None:
+        writer.byte(0)
+    else:
+        writer.byte(1)
+        writer.bytes(transaction.signature.encode("ISO-8859-1"))
+
+
+def read_transaction(reader):
+    data = {
+        'sender_address': reader.string(),
+        'receiver_address': reader.string(),
+        'amount': reader.int(),
+    }
+    data['input_txs'] = [reader.string() for _ in range(reader.count())]
+    transaction_id = reader.string()
+    output_txs = []
+    for _ in range(reader.count()):
+        tx_id = reader.string()
+        recipient = reader.byte()
+        if recipient == RECEIVER:
+            recipient_address = data['receiver_address']
+        elif recipient == SENDER:
+            recipient_address = data['sender_address']
+        elif recipient == SENDER_ACCOUNT:
+            recipient_address = account_id(data['sender_address'])
+        else:
+            recipient_address = reader.string()
+        output_txs.append({'id': tx_id, 'recipient': recipient_address, 'amount': reader.int()})
+    signature = None
+    if reader.byte():
+        signature = reader.bytes().decode("ISO-8859-1")
+    return checked(Transaction(transaction_dict={
+        'data': data,
+        'id': transaction_id,
+        'output_txs': output_txs,
+        'signature': signature
+    }))
+
+
+# A transaction sent as its JSON string within a binary block.
+def read_raw_transaction(reader):
+    transaction_json = reader.string()
+    if not transaction_json:
+        raise ValueError('Missing transaction')
+    try:
+        return checked(Transaction(transaction_json=transaction_json))
+    except (KeyError, TypeError, AttributeError):
+        raise ValueError('Malformed transaction')
+
+
+# Raises ValueError unless the decoded transaction has the fields of a
+# transaction with the expected types (e.g., a NONE tag for an address).
+def checked(transaction):
+    data = transaction.data
+    try:
+        if not isinstance(data['input_txs'], list) or not isinstance(transaction.output_txs, list):
+            raise ValueError('Malformed transaction field')
+        strings = [data['sender_address'], data['receiver_address'], transaction.id]
+        strings += data['input_txs']
+        ints = [data['amount']]
+        for tx in transaction.output_txs:
+            strings += [tx['id'], tx['recipient']]
+            ints.append(tx['amount'])
+    except (KeyError, TypeError):
+        raise ValueError('Missing transaction field')
+    if not all(isinstance(value, str) for value in strings) or \
+        not all(isinstance(value, int) and not isinstance(value, bool) for value in ints) or \
+        not isinstance(transaction.signature, (str, type(None))):
+        raise ValueError('Malformed transaction field')
+    return transaction
+
+
+def encode_transaction(transaction):
+    writer = Writer()
+    write_transaction(writer, transaction)
+    return writer.getvalue()
+
+
+def decode_transaction(payload):
+    return read_transaction(Reader(payload))
+
+
+# Raises ValueError for transactions that cannot be encoded.
+def encode_transactions(transactions):
+    writer = Writer()
+    writer.count(len(transactions))
+    for transaction in transactions:
+        write_transaction(writer, transaction)
+    return writer.getvalue()
+
+
+def decode_transactions(payload):
+    reader = Reader(payload)
+    return [read_transaction(reader) for _ in range(reader.count())]
+
+
+# Blocks hold their transactions as Transaction objects. A transaction is sent
+# in the structured form only if its JSON string is the canonical one, so that
+# it is reproduced exactly when decoded (raises ValueError for blocks that
+# cannot be encoded).
+def encode_block(block):
+    writer = Writer()
+    writer.int(block['index'])
+    writer.string(block['timestamp'])
+    writer.string(block['merkle_root'])
+    writer.int(block['nonce'])
+    writer.string(block['previous_hash'])
+    writer.string(block['current_hash'])
+    writer.count(len(block['transactions']))
+    for transaction in block['transactions']:
+        structured = Writer()
+        try:
+            if transaction.serialize() != transaction.jsonfy():
+                raise ValueError('Transaction is not in the canonical form')
+            write_transaction(structured, transaction)
+            writer.byte(STRUCTURED)
+            writer.parts.extend(structured.parts)
+        except ValueError:
+            writer.byte(RAW_JSON)
+            writer.string(transaction.jsonfy())
+    return writer.getvalue()
+
+
+def decode_block(payload):
+    reader = Reader(payload)
+    block = {
+        'index': reader.int(),
+        'timestamp': reader.string(),
+        'merkle_root': reader.string(),
+        'nonce': reader.int(),
+        'previous_hash': reader.string(),
+        'current_hash': reader.string(),
+        'transactions': []
+    }
+    for _ in range(reader.count()):
+        if reader.byte() == STRUCTURED:
+            block['transactions'].append(read_transaction(reader))
+        else:
+            block['transactions'].append(read_raw_transaction(reader))
+    return block